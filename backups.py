@@ -1,6 +1,161 @@
 import traceback
 import xenon_worker as wkr
 import asyncio
+import copy
+import math
+import msgpack
+import pymongo
+import time
+from datetime import timedelta
+from os import environ as env
+
+import utils
+import views
+
+
+# How many requests a single loader is allowed to have in flight at the same time
+# All loader phases of a guild share this budget
+LOADER_CONCURRENCY = int(env.get("LOADER_CONCURRENCY", 5))
+
+# Bans are exported page by page and stored in chunks of this size
+BAN_PAGE_SIZE = 1000
+# Report the export progress every n pages
+BAN_PROGRESS_PAGES = 5
+
+# Discord only allows a limited amount of role creations per guild and day
+ROLE_CREATION_CAP = 250
+
+# Approximations of the discord rate limits per route (requests, seconds)
+# and of the time a single request takes, used to estimate how long a load takes
+ROUTE_LIMITS = {
+    "delete_role": (5, 1),
+    "edit_role": (5, 1),
+    "create_role": (5, 1),
+    "role_positions": (1, 1),
+    "delete_channel": (5, 1),
+    "create_channel": (5, 1),
+    "edit_channel": (2, 10),
+    "channel_positions": (1, 1),
+    "ban_users": (5, 1),
+    "edit_guild": (2, 1)
+}
+DEFAULT_ROUTE_LIMIT = (5, 1)
+REQUEST_LATENCY = 0.3
+
+# The loader key expires if the loader isn't refreshed for this long (e.g. because the worker died)
+LOADER_TTL = 60
+# Progress events refresh the loader key at most this often
+HEARTBEAT_INTERVAL = 5
+# Single steps (fetching all bans, rate limits) can take longer than the ttl without any progress,
+# the key is also refreshed this often as long as the loader is alive
+LIVENESS_INTERVAL = 20
+
+# How long the progress of an interrupted loader can be resumed
+CHECKPOINT_TTL = 60 * 60 * 24 * 7
+
+# The order in which the operations of a single phase are executed
+ACTION_ORDER = ("delete_role", "edit_role", "create_role", "role_positions", "delete_channel", "create_channel",
+                "edit_channel", "channel_positions", "ban_users", "edit_guild")
+
+PLAN_LABELS = (
+    ("delete_role", "Delete roles"),
+    ("edit_role", "Edit roles"),
+    ("create_role", "Create roles"),
+    ("delete_channel", "Delete channels"),
+    ("edit_channel", "Edit channels"),
+    ("create_channel", "Create channels"),
+    ("ban_users", "Ban users")
+)
+
+PHASE_STATUS = {
+    "prepare": "starting",
+    "delete_roles": "deleting roles",
+    "roles": "loading roles",
+    "delete_channels": "deleting channels",
+    "channels": "loading channels",
+    "bans": "loading bans",
+    "settings": "loading settings",
+    "finish": "finishing"
+}
+
+# Fields that are compared when reconciling the guild with a backup
+ROLE_FIELDS = ("name", "permissions", "color", "hoist", "mentionable")
+CHANNEL_FIELDS = ("name", "topic", "nsfw", "bitrate", "user_limit", "rate_limit_per_user", "parent_id",
+                  "permission_overwrites")
+
+
+def _normalize(value):
+    if isinstance(value, list):
+        # Permission overwrites, the order doesn't matter
+        return sorted(
+            (str(o["id"]), str(o["type"]), str(o.get("allow")), str(o.get("deny")))
+            for o in value
+        )
+
+    return str(value)
+
+
+def _changed_fields(live, saved, fields):
+    return [
+        field for field in fields
+        if field in saved and _normalize(live.get(field)) != _normalize(saved[field])
+    ]
+
+
+def _match(saved, live, key, kind=lambda o: None):
+    """
+    Pair up saved and live objects, first by id (loading onto the source guild keeps them),
+    then by key with ties broken by position and then renamed objects of the same kind by position
+    Objects without a partner are paired with None
+    """
+    live_ids = {obj["id"]: obj for obj in live}
+    paired = set()
+    rest = []
+    for obj in saved:
+        partner = live_ids.get(obj["id"])
+        if partner is not None and id(partner) not in paired:
+            paired.add(id(partner))
+            yield obj, partner
+
+        else:
+            rest.append(obj)
+
+    live = [obj for obj in live if id(obj) not in paired]
+
+    def _groups(objects, group_key):
+        groups = {}
+        for obj in sorted(objects, key=lambda o: o.get("position") or 0):
+            groups.setdefault(group_key(obj), []).append(obj)
+
+        return groups
+
+    saved_left = []
+    live_left = []
+    saved_groups = _groups(rest, key)
+    live_groups = _groups(live, key)
+    for k in set(saved_groups.keys()) | set(live_groups.keys()):
+        saved_group = saved_groups.get(k, [])
+        live_group = live_groups.get(k, [])
+        yield from zip(saved_group, live_group)
+        saved_left.extend(saved_group[len(live_group):])
+        live_left.extend(live_group[len(saved_group):])
+
+    # Whatever is left and has the same kind and position was most likely renamed
+    live_positions = {}
+    for obj in live_left:
+        live_positions.setdefault((kind(obj), obj.get("position") or 0), []).append(obj)
+
+    for obj in saved_left:
+        candidates = live_positions.get((kind(obj), obj.get("position") or 0))
+        if candidates:
+            yield obj, candidates.pop(0)
+
+        else:
+            yield obj, None
+
+    for candidates in live_positions.values():
+        for obj in candidates:
+            yield None, obj
 
 
 class Options:
@@ -28,11 +183,24 @@ class Options:
 
 
 class BackupSaver:
-    def __init__(self, client, guild):
+    def __init__(self, client, guild, backup_id=None, progress=None):
         self.client = client
         self.guild = guild
         self.data = guild.to_dict()
 
+        # Bans are stored separately from the backup document if an id is given
+        self.backup_id = backup_id
+        self.progress = progress
+
+        self.options = Options(
+            roles=True,
+            channels=True,
+            members=True,
+            emojis=True,
+            bans=True
+        )
+        self.timings = {}
+
     async def _save_roles(self):
         self.data["roles"] = [
             r.to_dict()
@@ -40,30 +208,196 @@ class BackupSaver:
             if not r.managed
         ]
 
+    async def _save_channels(self):
+        # This includes the permission overwrites
+        self.data["channels"] = [c.to_dict() for c in self.guild.channels]
+
+    async def _save_members(self):
+        self.data["members"] = [m.to_dict() for m in self.guild.members]
+
+    async def _save_emojis(self):
+        # Managed emojis belong to integrations and can't be created
+        self.data["emojis"] = [e for e in self.data.get("emojis", []) if not e.get("managed")]
+
+    async def _iter_ban_pages(self):
+        after = None
+        while True:
+            path = f"/guilds/{self.guild.id}/bans?limit={BAN_PAGE_SIZE}"
+            if after is not None:
+                path += f"&after={after}"
+
+            page = await self.client.http.request(wkr.Route("GET", path))
+            if len(page) == 0:
+                break
+
+            yield page
+            if len(page) < BAN_PAGE_SIZE:
+                break
+
+            after = page[-1]["user"]["id"]
+
     async def _save_bans(self):
-        self.data["bans"] = [
-            {
-                "reason": ban["reason"],
-                "id": ban["user"]["id"]
-            }
-            for ban in await self.client.fetch_bans(self.guild)
-        ]
+        """
+        Export the bans page by page, only a single page is kept in memory
+        """
+        embedded = []
+        count = 0
+        index = 0
+        async for page in self._iter_ban_pages():
+            bans = [
+                {
+                    "reason": ban["reason"],
+                    "id": ban["user"]["id"]
+                }
+                for ban in page
+            ]
+            if self.backup_id is None:
+                embedded.extend(bans)
+
+            else:
+                await self.client.db.bans.replace_one({"backup": self.backup_id, "index": index}, {
+                    "backup": self.backup_id,
+                    "index": index,
+                    "bans": bans
+                }, upsert=True)
+
+            count += len(bans)
+            index += 1
+            if self.progress is not None and index % BAN_PROGRESS_PAGES == 0:
+                await self.progress(f"saving bans ({count})")
+
+        if self.backup_id is None:
+            self.data["bans"] = embedded
+
+        else:
+            # Remove chunks that are left over from a previous version of this backup
+            await self.client.db.bans.delete_many({"backup": self.backup_id, "index": {"$gte": index}})
+            self.data.pop("bans", None)
+            self.data["ban_count"] = count
+
+    async def _timed(self, key, saver):
+        start = time.perf_counter()
+        await saver()
+        self.timings[key] = time.perf_counter() - start
 
     async def save(self, **options):
+        self.options.update(**options)
         savers = {
             "roles": self._save_roles,
+            "channels": self._save_channels,
+            "members": self._save_members,
+            "emojis": self._save_emojis,
             "bans": self._save_bans
         }
 
-        for _, saver in savers.items():
-            await saver()
+        phases = []
+        for key, saver in savers.items():
+            if self.options.get(key):
+                phases.append(self._timed(key, saver))
+
+            else:
+                self.data.pop(key, None)
+
+        # The phases are independent of each other
+        await asyncio.gather(*phases)
+
+
+class LoadPlan:
+    """
+    The operations a loader is going to execute, grouped into phases
+    This is shown to the user before loading and then executed as-is by the loader
+    """
+    def __init__(self, concurrency=LOADER_CONCURRENCY):
+        self.concurrency = concurrency
+        self.phases = []
+        self.protected = {}
+        self.warnings = []
+
+        # Indexes of the operations that were already executed, only set when resuming
+        self.done = set()
+        self.resumed = False
+        self._index = 0
+
+    def add(self, key, ops):
+        for op in ops:
+            op["index"] = self._index
+            self._index += 1
+
+        if len(ops) > 0:
+            self.phases.append((key, ops))
+
+    def remaining(self, ops):
+        return [op for op in ops if op["index"] not in self.done]
+
+    @property
+    def operations(self):
+        return [op for _, ops in self.phases for op in self.remaining(ops)]
+
+    def to_dict(self):
+        return {
+            "phases": self.phases,
+            "protected": self.protected,
+            "warnings": self.warnings
+        }
+
+    @classmethod
+    def from_dict(cls, data, concurrency=LOADER_CONCURRENCY):
+        plan = cls(concurrency=concurrency)
+        plan.phases = [(key, ops) for key, ops in data["phases"]]
+        plan.protected = data["protected"]
+        plan.warnings = data["warnings"]
+        plan._index = sum(len(ops) for _, ops in plan.phases)
+        plan.resumed = True
+        return plan
+
+    def count(self, action):
+        return sum(op.get("count", 1) for op in self.operations if op["action"] == action)
+
+    @property
+    def api_calls(self):
+        return sum(op.get("count", 1) for op in self.operations)
+
+    @property
+    def estimated_duration(self):
+        seconds = 0
+        for _, ops in self.phases:
+            calls = {}
+            for op in self.remaining(ops):
+                calls[op["action"]] = calls.get(op["action"], 0) + op.get("count", 1)
+
+            # Either the rate limit or the concurrency budget is the bottleneck
+            for action, count in calls.items():
+                requests, per = ROUTE_LIMITS.get(action, DEFAULT_ROUTE_LIMIT)
+                seconds += max(count * per / requests, count * REQUEST_LATENCY / self.concurrency)
+
+        return timedelta(seconds=math.ceil(seconds))
+
+    def summary(self):
+        lines = [
+            f"{label}: `{self.count(action)}`"
+            for action, label in PLAN_LABELS
+            if self.count(action) > 0
+        ]
+        if self.resumed:
+            lines.insert(0, f"Resuming, already done: `{len(self.done)}` operations")
+
+        lines.append(f"API calls: `{self.api_calls}` "
+                     f"(about `{utils.timedelta_to_string(self.estimated_duration)}`)")
+        lines.extend("⚠️ " + warning for warning in self.warnings)
+        return "\n".join(lines)
 
 
 class BackupLoader:
-    def __init__(self, client, guild, data, reason="Backup loaded"):
+    def __init__(self, client, guild, data, reason="Backup loaded", concurrency=LOADER_CONCURRENCY, backup_id=None,
+                 source=None):
         self.client = client
         self.guild = guild
         self.data = data
+        # Attribute access to the saved roles and channels without copying them
+        self.saved = views.GuildView(data)
+        self.backup_id = backup_id
+        # Identifies what is loaded, an interrupted loader can only be resumed with the same source
+        self.source = source or backup_id
 
         self.options = Options(
             settings=True,
@@ -71,59 +405,489 @@ class BackupLoader:
             delete_roles=True,
             channels=True,
             delete_channels=True,
-            bans=False
+            bans=False,
+            reconcile=False
         )
         self.id_translator = {data["id"]: guild.id}
         self.reason = reason
+        self.concurrency = concurrency
 
         self._member_cache = {}
+        self._budget = asyncio.Semaphore(concurrency)
+
+        self.plan = None
+        self.summary = {}
+
+        self._redis_key = f"loaders:{guild.id}"
+        self._running = False
+        self._last_heartbeat = 0
+        self._heartbeats = set()
+        self._keep_alive_task = None
+        self._ban_task = None
+        self._finished_phases = False
+        self._status = None
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, value):
+        self._status = value
+        self._heartbeat(force=True)
+
+    def _heartbeat(self, force=False):
+        """
+        Refresh the loader key, this is triggered by the progress of the loader itself
+        """
+        if not self._running or self._status is None:
+            return
+
+        now = time.monotonic()
+        if not force and now - self._last_heartbeat < HEARTBEAT_INTERVAL:
+            return
+
+        self._last_heartbeat = now
+        task = self.client.schedule(self.client.redis.setex(self._redis_key, LOADER_TTL, self._status))
+        self._heartbeats.add(task)
+        task.add_done_callback(self._heartbeats.discard)
+
+    async def _keep_alive(self):
+        while self._running:
+            await asyncio.sleep(LIVENESS_INTERVAL)
+            self._heartbeat(force=True)
+
+    async def _bounded(self, coro):
+        async with self._budget:
+            return await coro
+
+    async def _gather(self, coros):
+        """
+        Run the coroutines concurrently
+        If one of them raises (e.g. because a discord limit was hit), all remaining ones get cancelled
+        """
+        tasks = [asyncio.ensure_future(coro) for coro in coros]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _run_bounded(self, coros):
+        """
+        Run the coroutines concurrently without exceeding the concurrency budget of this loader
+        """
+        return await self._gather([self._bounded(coro) for coro in coros])
+
+    def _top_role_position(self):
+        """
+        Position of the highest role of the bot, the bot can't delete or edit roles above it
+        """
+        me = next((m for m in self.guild.members if m.id == self.client.user.id), None)
+        if me is None:
+            return None
+
+        positions = [r.position for r in self.guild.roles if r.id in me.roles]
+        return max(positions) if len(positions) > 0 else 0
 
-        self.status = None
+    def _tune_channel(self, channel):
+        channel.pop("guild_id", None)
 
-    async def _load_settings(self):
-        self.status = "loading settings"
+        # Bitrates over 96000 require special features or boosts
+        # (boost advantages change a lot, so we just ignore them)
+        if "bitrate" in channel.keys() and "VIP_REGIONS" not in self.guild.features:
+            channel["bitrate"] = min(channel["bitrate"], 96000)
 
-        self.data.pop("guild_id", None)
-        await self.client.edit_guild(self.guild, **self.data, reason=self.reason)
+        # News and store channels require special features
+        if (channel["type"] == wkr.ChannelType.GUILD_NEWS and "NEWS" not in self.guild.features) or \
+                (channel["type"] == wkr.ChannelType.GUILD_STORE and "COMMERCE" not in self.guild.features):
+            channel["type"] = 0
 
-    async def _delete_roles(self):
-        self.status = "deleting roles"
+        channel["type"] = 0 if channel["type"] > 4 else channel["type"]
 
+        if channel.get("parent_id") is not None:
+            if channel["parent_id"] in self.id_translator:
+                channel["parent_id"] = self.id_translator[channel["parent_id"]]
+
+            else:
+                # The category couldn't be created, create the channel without one
+                channel.pop("parent_id")
+
+        overwrites = channel.get("permission_overwrites", [])
+        for overwrite in overwrites:
+            if overwrite["id"] in self.id_translator:
+                overwrite["id"] = self.id_translator[overwrite["id"]]
+
+        return channel
+
+    def _protected_roles(self):
+        """
+        Ids of the existing roles at or above the top role of the bot
+        """
+        top_position = self._top_role_position()
+        if top_position is None:
+            return set()
+
+        return {r.id for r in self.guild.roles if not r.is_default() and r.position >= top_position}
+
+    def _role_order(self):
+        """
+        The new ids of all translated roles in the saved order (lowest first),
+        roles the bot can't move are left out
+        """
+        protected = self._protected_roles()
+        return [
+            self.id_translator[r.id]
+            for r in sorted(self.saved.roles, key=lambda r: r.position)
+            if r.id != self.saved.id and r.id in self.id_translator and self.id_translator[r.id] not in protected
+        ]
+
+    def _plan_delete_roles(self, plan):
         existing = [
             r for r in self.guild.roles
             if not r.managed and not r.is_default()
         ]
 
-        for role in sorted(existing, key=lambda r: r.position):
-            try:
-                await self.client.delete_role(role, reason=self.reason)
-            except wkr.Forbidden:
-                break
+        top_position = self._top_role_position()
+        ops = []
+        for role in existing:
+            if top_position is None or role.position < top_position:
+                ops.append({"action": "delete_role", "target": role.id})
 
-            except wkr.DiscordException:
-                pass
+            else:
+                plan.protected["roles"] = plan.protected.get("roles", 0) + 1
 
-    async def _load_roles(self):
-        self.status = "loading roles"
-        roles = list(sorted(self.data["roles"], key=lambda r: r["position"], reverse=True))
-        for role in roles:
-            role.pop("guild_id", None)
-            role.pop("position", None)
-            role.pop("managed", None)
+        plan.add("delete_roles", ops)
 
+    def _plan_roles(self, plan):
+        ops = []
+        for role in self.data["roles"]:
             # Default role (@everyone)
             if role["id"] == self.data["id"]:
-                to_edit = self.guild.default_role
-                if to_edit is not None:
-                    try:
-                        await self.client.edit_role(to_edit, **role, reason=self.reason)
-                        self.id_translator[role["id"]] = to_edit.id
-
-                    except wkr.DiscordException:
-                        traceback.print_exc()
+                if self.guild.default_role is not None:
+                    self.id_translator[role["id"]] = self.guild.default_role.id
+                    ops.append({"action": "edit_role", "target": self.guild.default_role.id, "data": role,
+                                "fields": [k for k in role.keys() if k not in ("id", "guild_id", "position", "managed")]})
 
                 continue
 
+            ops.append({"action": "create_role", "data": role})
+
+        # Roles get created concurrently and end up in random order
+        if len(ops) > 0:
+            ops.append({"action": "role_positions"})
+
+        plan.add("roles", ops)
+
+    def _plan_delete_channels(self, plan):
+        plan.add("delete_channels", [
+            {"action": "delete_channel", "target": channel.id}
+            for channel in self.guild.channels
+        ])
+
+    def _plan_channels(self, plan):
+        ops = [
+            {"action": "create_channel", "data": channel}
+            for channel in self.data["channels"]
+        ]
+        if len(ops) > 0:
+            ops.append({"action": "channel_positions"})
+
+        plan.add("channels", ops)
+
+    def _plan_reconcile_roles(self, plan):
+        """
+        Compare the roles of the guild with the roles of the backup
+        and plan the minimal set of operations to get from one to the other
+        """
+        # Roles above the bot are still matched, so they don't get created again, but never edited or deleted
+        protected = self._protected_roles()
+        live = [
+            r.to_dict() for r in self.guild.roles
+            if not r.managed and not r.is_default()
+        ]
+        saved = [
+            r for r in self.data["roles"]
+            if r["id"] != self.data["id"] and not r.get("managed")
+        ]
+
+        ops = []
+        default = self.saved.default_role
+        if default is not None and self.guild.default_role is not None:
+            self.id_translator[default.id] = self.guild.default_role.id
+            fields = _changed_fields(self.guild.default_role.to_dict(), default.to_dict(), ROLE_FIELDS)
+            if fields:
+                ops.append({"action": "edit_role", "target": self.guild.default_role.id, "data": default.to_dict(),
+                            "fields": fields})
+
+        for saved_role, live_role in _match(saved, live, key=lambda r: r["name"]):
+            if live_role is None:
+                ops.append({"action": "create_role", "data": saved_role})
+
+            elif saved_role is None:
+                if live_role["id"] in protected:
+                    if self.options.delete_roles:
+                        plan.protected["roles"] = plan.protected.get("roles", 0) + 1
+
+                elif self.options.delete_roles:
+                    ops.append({"action": "delete_role", "target": live_role["id"]})
+
+            else:
+                self.id_translator[saved_role["id"]] = live_role["id"]
+                if live_role["id"] in protected:
+                    plan.protected["roles"] = plan.protected.get("roles", 0) + 1
+                    continue
+
+                fields = _changed_fields(live_role, saved_role, ROLE_FIELDS)
+                if fields:
+                    ops.append({"action": "edit_role", "target": live_role["id"], "data": saved_role,
+                                "fields": fields})
+
+        # Only touch the hierarchy if new roles are added or the existing ones are out of order
+        positions = {r.id: r.position for r in self.guild.roles}
+        order = self._role_order()
+        if any(op["action"] == "create_role" for op in ops) or order != sorted(order, key=positions.get):
+            ops.append({"action": "role_positions"})
+
+        plan.add("roles", ops)
+
+    def _plan_reconcile_channels(self, plan):
+        """
+        Compare the channels of the guild with the channels of the backup
+        and plan the minimal set of operations to get from one to the other
+        """
+        live = [c.to_dict() for c in self.guild.channels]
+        ops = []
+
+        def _kind(channel):
+            # Store and news channels might get converted to text channels
+            return self._tune_channel({"type": channel["type"]})["type"]
+
+        def _key(channel):
+            return _kind(channel), channel["name"]
+
+        # Categories have to be matched first, the other channels reference them
+        for category_only in (True, False):
+            saved_part = [
+                c for c in self.data["channels"]
+                if (c["type"] == wkr.ChannelType.GUILD_CATEGORY) == category_only
+            ]
+            live_part = [
+                c for c in live
+                if (c["type"] == wkr.ChannelType.GUILD_CATEGORY) == category_only
+            ]
+            for saved_channel, live_channel in _match(saved_part, live_part, key=_key, kind=_kind):
+                if live_channel is None:
+                    ops.append({"action": "create_channel", "data": saved_channel})
+
+                elif saved_channel is None:
+                    if self.options.delete_channels:
+                        ops.append({"action": "delete_channel", "target": live_channel["id"]})
+
+                else:
+                    self.id_translator[saved_channel["id"]] = live_channel["id"]
+                    tuned = self._tune_channel(copy.deepcopy(saved_channel))
+                    fields = _changed_fields(live_channel, tuned, CHANNEL_FIELDS)
+                    if saved_channel.get("parent_id") is not None and "parent_id" not in tuned:
+                        # The category doesn't exist yet and gets created later
+                        fields.append("parent_id")
+
+                    if fields:
+                        ops.append({"action": "edit_channel", "target": live_channel["id"], "data": saved_channel,
+                                    "fields": fields})
+
+        positions = {c.id: c.position for c in self.guild.channels}
+        if any(op["action"] == "create_channel" for op in ops) or any(
+            positions.get(self.id_translator.get(c["id"])) not in (None, c.get("position"))
+            for c in self.data["channels"]
+        ):
+            ops.append({"action": "channel_positions"})
+
+        plan.add("channels", ops)
+
+    def _ban_count(self):
+        if "bans" in self.data:
+            return len(self.data["bans"])
+
+        return self.data.get("ban_count", 0)
+
+    def _plan_bans(self, plan):
+        count = self._ban_count()
+        if count > 0:
+            plan.add("bans", [{"action": "ban_users", "count": count}])
+
+    def _plan_settings(self, plan):
+        plan.add("settings", [{"action": "edit_guild"}])
+
+    @property
+    def _checkpoint_key(self):
+        return f"checkpoints:{self.guild.id}"
+
+    async def _save_checkpoint(self):
+        key = self._checkpoint_key
+        tr = self.client.redis.multi_exec()
+        tr.delete(key + ":done", key + ":ids")
+        tr.setex(key + ":plan", CHECKPOINT_TTL, msgpack.packb({
+            "source": self.source,
+            **self.plan.to_dict()
+        }))
+        if self.id_translator:
+            # Packed, ids of crossloaded templates aren't strings
+            tr.hmset_dict(key + ":ids", {
+                msgpack.packb(old): msgpack.packb(new)
+                for old, new in self.id_translator.items()
+            })
+            tr.expire(key + ":ids", CHECKPOINT_TTL)
+        await tr.execute()
+
+    async def _checkpoint(self, op, translated=None):
+        """
+        Mark the operation as done, so an interrupted load can continue after it
+        """
+        self.plan.done.add(op["index"])
+        self._heartbeat()
+
+        key = self._checkpoint_key
+        tr = self.client.redis.multi_exec()
+        tr.sadd(key + ":done", op["index"])
+        tr.expire(key + ":done", CHECKPOINT_TTL)
+        if translated is not None:
+            tr.hset(key + ":ids", *[msgpack.packb(id) for id in translated])
+            tr.expire(key + ":ids", CHECKPOINT_TTL)
+
+        await tr.execute()
+
+    async def _clear_checkpoint(self):
+        key = self._checkpoint_key
+        await self.client.redis.delete(key + ":plan", key + ":done", key + ":ids")
+
+    async def restore_plan(self):
+        """
+        Restore the plan and progress of an interrupted loader on this guild
+        Returns None if there is nothing to resume
+        """
+        key = self._checkpoint_key
+        packed = await self.client.redis.get(key + ":plan")
+        if packed is None:
+            return None
+
+        data = msgpack.unpackb(packed, raw=False)
+        if self.source is None or data["source"] != self.source:
+            # The interrupted loader was loading something else
+            return None
+
+        plan = LoadPlan.from_dict(data, concurrency=self.concurrency)
+        plan.done = {int(index) for index in await self.client.redis.smembers(key + ":done")}
+        translated = await self.client.redis.hgetall(key + ":ids")
+        self.id_translator.update({
+            msgpack.unpackb(old, raw=False): msgpack.unpackb(new, raw=False)
+            for old, new in translated.items()
+        })
+        return plan
+
+    async def create_plan(self, **options):
+        """
+        Turn the backup data and the current state of the guild into the operations that are needed to load it
+        """
+        self.options.update(**options)
+        plan = LoadPlan(concurrency=self.concurrency)
+        plan.add("prepare", [{"action": "edit_guild", "data": {"name": "Loading ..."}}])
+
+        if self.options.reconcile:
+            # Only apply what differs between the guild and the backup
+            planners = (
+                ("roles", self._plan_reconcile_roles),
+                ("channels", self._plan_reconcile_channels),
+                ("bans", self._plan_bans),
+                ("settings", self._plan_settings)
+            )
+
+        else:
+            planners = (
+                ("delete_roles", self._plan_delete_roles),
+                ("roles", self._plan_roles),
+                ("delete_channels", self._plan_delete_channels),
+                ("channels", self._plan_channels),
+                ("bans", self._plan_bans),
+                ("settings", self._plan_settings)
+            )
+
+        for key, planner in planners:
+            if self.options.get(key):
+                planner(plan)
+
+        plan.add("finish", [{"action": "edit_guild", "data": {"name": self.data["name"]}}])
+
+        role_count = plan.count("create_role")
+        if role_count > ROLE_CREATION_CAP:
+            plan.warnings.append(f"This creates **{role_count} roles**, discord only allows "
+                                 f"**{ROLE_CREATION_CAP} per 24h**. The loader will stop when the limit is hit.")
+
+        if plan.protected.get("roles", 0) > 0:
+            plan.warnings.append(f"**{plan.protected['roles']} roles** are above the bot and can't be deleted. "
+                                 f"Move the bot's role to the top to replace them.")
+
+        return plan
+
+    async def _delete_all(self, kind, ops, objects, delete):
+        """
+        Delete the objects concurrently and keep count of the results
+        """
+        protected = self.plan.protected.get(kind, 0)
+        result = {"deleted": 0, "failed": 0, "protected": protected}
+
+        async def _delete(op):
+            obj = objects.get(op["target"])
+            if obj is None:
+                result["failed"] += 1
+                await self._checkpoint(op)
+                return
+
+            try:
+                await delete(obj, reason=self.reason)
+            except wkr.DiscordException:
+                result["failed"] += 1
+
+            else:
+                result["deleted"] += 1
+
+            await self._checkpoint(op)
+
+        await self._run_bounded([_delete(op) for op in ops])
+
+        self.summary["delete_" + kind] = result
+        self.status = f"deleted {result['deleted']}/{len(ops) + protected} {kind} " \
+                      f"({protected} protected, {result['failed']} failed)"
+
+    async def _edit_all(self, ops, objects, edit, tune=None):
+        """
+        Apply edit operations concurrently, only the changed fields are sent
+        """
+        async def _edit(op):
+            obj = objects.get(op["target"])
+            if obj is not None:
+                data = copy.deepcopy(op["data"])
+                if tune is not None:
+                    data = tune(data)
+
+                try:
+                    await edit(obj, **{field: data.get(field) for field in op["fields"]}, reason=self.reason)
+                except wkr.DiscordException:
+                    traceback.print_exc()
+
+            await self._checkpoint(op)
+
+        await self._run_bounded([_edit(op) for op in ops])
+
+    async def _create_roles(self, ops):
+        """
+        Create the roles concurrently, their order gets restored afterwards
+        """
+        async def _create(op):
+            role = dict(op["data"])
+            role.pop("guild_id", None)
+            role.pop("managed", None)
+            role.pop("position", None)
             try:
                 new = await asyncio.wait_for(
                     self.client.create_role(self.guild, **role, reason=self.reason),
@@ -137,118 +901,285 @@ class BackupLoader:
 
             except wkr.DiscordException:
                 traceback.print_exc()
-                continue
+                await self._checkpoint(op)
+                return
 
             self.id_translator[role["id"]] = new.id
+            await self._checkpoint(op, translated=(role["id"], new.id))
+
+        await self._run_bounded([_create(op) for op in ops])
 
-    async def _delete_channels(self):
-        self.status = "deleting channels"
+    async def _create_channels(self, ops):
+        """
+        Create the channels concurrently, children only wait for their own category
+        """
+        # Categories are scheduled first so their children are unblocked as early as possible
+        ops = sorted(
+            ops,
+            key=lambda o: (o["data"]["type"] != wkr.ChannelType.GUILD_CATEGORY, o["data"].get("position") or 0)
+        )
+
+        # Channels form a dependency graph: children can only be created after their category
+        created = {
+            op["data"]["id"]: asyncio.Event()
+            for op in ops
+            if op["data"]["type"] == wkr.ChannelType.GUILD_CATEGORY
+        }
 
-        for channel in self.guild.channels:
+        async def _create(op):
+            channel = copy.deepcopy(op["data"])
             try:
-                await self.client.delete_channel(channel, reason=self.reason)
+                new = await self.client.create_channel(self.guild, **self._tune_channel(channel), reason=self.reason)
             except wkr.DiscordException:
                 traceback.print_exc()
+                await self._checkpoint(op)
+                return
 
-    async def _load_channels(self):
-        self.status = "loading channels"
+            self.id_translator[channel["id"]] = new.id
+            await self._checkpoint(op, translated=(channel["id"], new.id))
 
-        def _tune_channel(channel):
-            channel.pop("guild_id", None)
+        async def _schedule(op):
+            parent = created.get(op["data"].get("parent_id"))
+            if parent is not None:
+                await parent.wait()
 
-            # Bitrates over 96000 require special features or boosts
-            # (boost advantages change a lot, so we just ignore them)
-            if "bitrate" in channel.keys() and "VIP_REGIONS" not in self.guild.features:
-                channel["bitrate"] = min(channel["bitrate"], 96000)
+            try:
+                await self._bounded(_create(op))
+            finally:
+                if op["data"]["id"] in created:
+                    created[op["data"]["id"]].set()
 
-            # News and store channels require special features
-            if (channel["type"] == wkr.ChannelType.GUILD_NEWS and "NEWS" not in self.guild.features) or \
-                    (channel["type"] == wkr.ChannelType.GUILD_STORE and "COMMERCE" not in self.guild.features):
-                channel["type"] = 0
+        await self._gather([_schedule(op) for op in ops])
 
-            channel["type"] = 0 if channel["type"] > 4 else channel["type"]
+    async def _fix_positions(self, kind, positions):
+        """
+        Restore the saved order of roles or channels with a single bulk request
+        """
+        if len(positions) == 0:
+            return
 
-            if "parent_id" in channel.keys():
-                channel["parent_id"] = self.id_translator.get(channel["parent_id"], channel["parent_id"])
+        try:
+            await self.client.http.request(
+                wkr.Route("PATCH", "/guilds/" + str(self.guild.id) + "/" + kind),
+                json=positions
+            )
+        except wkr.DiscordException:
+            traceback.print_exc()
 
-            overwrites = channel.get("permission_overwrites", [])
-            for overwrite in overwrites:
-                if overwrite["id"] in self.id_translator:
-                    overwrite["id"] = self.id_translator[overwrite["id"]]
+    async def _iter_bans(self):
+        if "bans" in self.data:
+            for ban in self.data["bans"]:
+                yield ban
 
-            return channel
+        elif self.backup_id is not None:
+            # Bans are stored in chunks next to the backup
+            chunks = self.client.db.bans.find({"backup": self.backup_id}, sort=[("index", pymongo.ASCENDING)])
+            async for chunk in chunks:
+                for ban in chunk["bans"]:
+                    yield ban
 
-        no_parent = sorted(
-            filter(lambda c: c.get("parent_id") is None, self.data["channels"]),
-            key=lambda c: c.get("position")
-        )
-        for channel in no_parent:
-            try:
-                new = await self.client.create_channel(self.guild, **_tune_channel(channel), reason=self.reason)
-                self.id_translator[channel["id"]] = new.id
-            except wkr.DiscordException:
-                traceback.print_exc()
+    async def _load_bans(self, op):
+        """
+        Restore the bans concurrently, users that are already banned are skipped
+        This runs in the background, the rest of the load doesn't wait for it
+        """
+        result = {"banned": 0, "skipped": 0, "failed": 0}
+        self.summary["bans"] = result
 
-        has_parent = sorted(
-            filter(lambda c: c.get("parent_id") is not None, self.data["channels"]),
-            key=lambda c: c["position"]
-        )
-        for channel in has_parent:
-            try:
-                new = await self.client.create_channel(self.guild, **_tune_channel(channel), reason=self.reason)
-                self.id_translator[channel["id"]] = new.id
-            except wkr.DiscordException:
-                traceback.print_exc()
+        try:
+            existing = {ban["user"]["id"] for ban in await self.client.fetch_bans(self.guild)}
+        except wkr.DiscordException:
+            traceback.print_exc()
+            existing = set()
 
-    async def _load_bans(self):
-        self.status = "loading bans"
+        total = self._ban_count()
+        workers = max(min(self.concurrency, total), 1)
 
-        for ban in self.data.get("bans", []):
-            try:
-                await self.client.ban_user(self.guild, wkr.Snowflake(ban["id"]), reason=ban["reason"])
-            except wkr.DiscordException:
-                pass
+        # The bans are streamed through a bounded queue instead of being loaded at once
+        queue = asyncio.Queue(maxsize=workers * 10)
 
-    async def _load(self, **options):
-        self.options.update(**options)
-        await self.client.edit_guild(self.guild, name="Loading ...")
-        loaders = (
-            ("delete_roles", self._delete_roles),
-            ("roles", self._load_roles),
-            ("delete_channels", self._delete_channels),
-            ("channels", self._load_channels),
-            ("bans", self._load_bans),
-            ("settings", self._load_settings)
-        )
+        async def _producer():
+            async for ban in self._iter_bans():
+                if ban["id"] in existing:
+                    result["skipped"] += 1
+
+                else:
+                    await queue.put(ban)
+
+            for _ in range(workers):
+                await queue.put(None)
+
+        async def _worker():
+            # Rate limits are handled by the http client, the workers only bound the concurrency
+            while True:
+                ban = await queue.get()
+                if ban is None:
+                    break
 
-        for key, loader in loaders:
-            if self.options.get(key):
                 try:
-                    await loader()
-                except wkr.CommandError:
-                    raise
+                    await self._bounded(
+                        self.client.ban_user(self.guild, wkr.Snowflake(ban["id"]), reason=ban["reason"])
+                    )
                 except wkr.DiscordException:
-                    traceback.print_exc()
+                    result["failed"] += 1
 
-        await self.client.edit_guild(self.guild, name=self.data["name"])
+                else:
+                    result["banned"] += 1
 
-    async def load(self, **options):
-        self.status = "starting"
+                done = result["banned"] + result["failed"] + result["skipped"]
+                if done % 50 == 0:
+                    self.status = f"loading bans ({done}/{total}, {result['failed']} failed)"
+
+        await self._gather([_producer()] + [_worker() for _ in range(workers)])
+
+        self.status = f"loaded bans ({result['banned']} banned, {result['skipped']} already banned, " \
+                      f"{result['failed']} failed)"
+        await self._checkpoint(op)
+        if self._finished_phases:
+            await self._clear_checkpoint()
+
+    async def _apply(self, ops):
+        """
+        Execute the operations of a single phase
+        """
+        by_action = {}
+        for op in self.plan.remaining(ops):
+            by_action.setdefault(op["action"], []).append(op)
 
-        redis_key = f"loaders:{self.guild.id}"
-        if await self.client.redis.exists(redis_key):
+        roles = {r.id: r for r in self.guild.roles}
+        channels = {c.id: c for c in self.guild.channels}
+
+        for action in ACTION_ORDER:
+            action_ops = by_action.get(action)
+            if action_ops is None:
+                continue
+
+            if action == "delete_role":
+                await self._delete_all("roles", action_ops, roles, self.client.delete_role)
+
+            elif action == "edit_role":
+                await self._edit_all(action_ops, roles, self.client.edit_role)
+
+            elif action == "create_role":
+                await self._create_roles(action_ops)
+
+            elif action == "role_positions":
+                await self._fix_positions("roles", [
+                    {"id": role_id, "position": i + 1}
+                    for i, role_id in enumerate(self._role_order())
+                ])
+                await self._checkpoint(action_ops[0])
+
+            elif action == "delete_channel":
+                await self._delete_all("channels", action_ops, channels, self.client.delete_channel)
+
+            elif action == "create_channel":
+                await self._create_channels(action_ops)
+
+            elif action == "edit_channel":
+                await self._edit_all(action_ops, channels, self.client.edit_channel, tune=self._tune_channel)
+
+            elif action == "channel_positions":
+                # New channels and the ones that moved
+                await self._fix_positions("channels", [
+                    {"id": self.id_translator[c["id"]], "position": c["position"]}
+                    for c in self.data["channels"]
+                    if c["id"] in self.id_translator and c.get("position") is not None and
+                    getattr(channels.get(self.id_translator[c["id"]]), "position", None) != c["position"]
+                ])
+                await self._checkpoint(action_ops[0])
+
+            elif action == "ban_users":
+                self._ban_task = self.client.schedule(self._load_bans(action_ops[0]))
+
+            elif action == "edit_guild":
+                for op in action_ops:
+                    data = op.get("data", self.data)
+                    data.pop("guild_id", None)
+                    await self.client.edit_guild(self.guild, **data, reason=self.reason)
+                    await self._checkpoint(op)
+
+    async def _load(self, plan):
+        if not plan.resumed:
+            await self._save_checkpoint()
+
+        for key, ops in plan.phases:
+            self.status = PHASE_STATUS.get(key, key)
+            try:
+                await self._apply(ops)
+            except wkr.CommandError:
+                # The checkpoint is kept, the load can be resumed later (e.g. after the role limit reset)
+                raise
+            except wkr.DiscordException:
+                traceback.print_exc()
+
+        # The ban tail clears the checkpoint itself if it's still running
+        self._finished_phases = True
+        if self._ban_task is None or self._ban_task.done():
+            await self._clear_checkpoint()
+
+    async def _release(self, cancelled, cancel_channel):
+        self._running = False
+        self._keep_alive_task.cancel()
+        cancelled.cancel()
+        await self.client.redis.unsubscribe(cancel_channel)
+
+        # Pending heartbeats would otherwise recreate the key after it got deleted
+        await asyncio.gather(*self._heartbeats, return_exceptions=True)
+        await self.client.redis.delete(self._redis_key)
+
+    async def _finish_bans(self, cancelled, cancel_channel):
+        """
+        Keep the loader running until the ban tail is done or the load gets cancelled
+        """
+        try:
+            await asyncio.wait([self._ban_task, cancelled], return_when=asyncio.FIRST_COMPLETED)
+            if not self._ban_task.done():
+                self._ban_task.cancel()
+
+        finally:
+            await self._release(cancelled, cancel_channel)
+
+    async def load(self, plan=None, **options):
+        redis = self.client.redis
+        claimed = await redis.set(self._redis_key, "starting", expire=LOADER_TTL, exist=redis.SET_IF_NOT_EXIST)
+        if not claimed:
             # Another loader is already running
             raise self.client.f.ERROR("There is **already** a backup or template loader **running**. "
                                       "You can't start more than one at the same time.\n"
                                       "You have to **wait until it's done**.")
 
-        task = self.client.schedule(self._load(**options))
-        while not task.done():
-            await self.client.redis.setex(redis_key, 10, self.status)
-            await asyncio.sleep(5)
-            if not await self.client.redis.exists(redis_key):
-                # The loading key got deleted, probably manual cancellation
+        self._running = True
+        self.status = "starting"
+        self._keep_alive_task = self.client.schedule(self._keep_alive())
+
+        # Manual cancellation is published on this channel
+        cancel_channel = f"loaders:cancel:{self.guild.id}"
+        channel, = await redis.subscribe(cancel_channel)
+        cancelled = self.client.schedule(channel.wait_message())
+        background = False
+        try:
+            if plan is None:
+                plan = await self.create_plan(**options)
+
+            self.plan = plan
+            task = self.client.schedule(self._load(plan))
+            await asyncio.wait([task, cancelled], return_when=asyncio.FIRST_COMPLETED)
+            if not task.done():
                 task.cancel()
+                if self._ban_task is not None:
+                    self._ban_task.cancel()
+
                 raise self.client.f.ERROR("The **loading process was cancelled**. Did you cancel it manually?")
 
-        return task.result()
+            result = task.result()
+            if self._ban_task is not None and not self._ban_task.done():
+                # The rest of the load is done, the loader is released once the ban tail finished
+                background = True
+                self.client.schedule(self._finish_bans(cancelled, cancel_channel))
+
+            return result
+
+        finally:
+            if not background:
+                await self._release(cancelled, cancel_channel)
@@ -1,4 +1,5 @@
 import xenon_worker as wkr
+import asyncio
 from enum import Enum
 
 
@@ -14,15 +15,79 @@ class NotStaff(wkr.CheckFailed):
         self.required = required
 
 
+# Changes to the staff list are published here, so every worker can update its cache
+STAFF_CHANNEL = "staff:updates"
+
+
+class StaffCache:
+    """
+    All staff levels in memory, loaded once and kept up to date through redis
+    """
+
+    def __init__(self):
+        self.levels = None
+        # Updates that arrived while the levels were loaded, one list per load
+        self._pending = []
+        self._lock = None
+
+    @staticmethod
+    def _apply(levels, update):
+        if update[0] == "add":
+            levels[update[1]] = int(update[2])
+
+        else:
+            levels.pop(update[1], None)
+
+    async def load(self, db):
+        pending = []
+        self._pending.append(pending)
+        try:
+            levels = {staff["_id"]: staff["level"] async for staff in db.staff.find({})}
+            for update in pending:
+                self._apply(levels, update)
+
+            self.levels = levels
+
+        finally:
+            self._pending.remove(pending)
+
+    async def get_levels(self, db):
+        if self.levels is None:
+            if self._lock is None:
+                # Created lazily to bind it to the running loop
+                self._lock = asyncio.Lock()
+
+            async with self._lock:
+                if self.levels is None:
+                    await self.load(db)
+
+        return self.levels
+
+    async def get_level(self, db, user_id):
+        levels = await self.get_levels(db)
+        return StaffLevel(levels.get(user_id, StaffLevel.NONE.value))
+
+    async def update(self, message):
+        update = message.split(":")
+        for pending in self._pending:
+            pending.append(update)
+
+        if self.levels is not None:
+            self._apply(self.levels, update)
+
+
+staff_cache = StaffCache()
+
+
 def is_staff(level=StaffLevel.MOD):
     def predicate(callback):
         async def check(ctx, *args, **kwargs):
-            staff = await ctx.bot.db.staff.find_one({"_id": ctx.author.id})
-            if staff is None:
+            current = await staff_cache.get_level(ctx.bot.db, ctx.author.id)
+            if current == StaffLevel.NONE:
                 raise NotStaff(required=level)
 
-            if staff["level"] < level.value:
-                raise NotStaff(current=StaffLevel(staff["level"]), required=level)
+            if current.value < level.value:
+                raise NotStaff(current=current, required=level)
 
             return True
 
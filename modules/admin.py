@@ -1,6 +1,5 @@
 import xenon_worker as wkr
 import inspect
-import pymongo
 from datetime import timedelta, datetime
 from contextlib import redirect_stdout
 import textwrap
@@ -14,19 +13,16 @@ class StaffListMenu(wkr.ListMenu):
     embed_kwargs = {"title": "Staff List"}
 
     async def get_items(self):
-        args = {
-            "limit": 10,
-            "skip": self.page * 10,
-            "sort": [("level", pymongo.DESCENDING)],
-            "filter": {}
-        }
-        staff_list = self.ctx.bot.db.staff.find(**args)
+        levels = await checks.staff_cache.get_levels(self.ctx.bot.db)
+        staff_list = sorted(levels.items(), key=lambda s: (s[1], s[0]), reverse=True)
+        staff_list = staff_list[self.page * 10:(self.page + 1) * 10]
+
+        names = await utils.resolve_users(self.ctx.client, [user_id for user_id, _ in staff_list])
         items = []
-        async for staff in staff_list:
-            user = await self.ctx.client.fetch_user(staff["_id"])
+        for user_id, level in staff_list:
             items.append((
-                checks.StaffLevel(staff["level"]).name.lower(),
-                str(user)
+                checks.StaffLevel(level).name.lower(),
+                names.get(user_id, user_id)
             ))
 
         return items
@@ -37,6 +33,19 @@ class Admin(wkr.Module):
         super().__init__(*args, **kwargs)
         self._last_exec = None
 
+    @wkr.Module.listener()
+    async def on_load(self, *_, **__):
+        # The cache is loaded after subscribing, so no change gets lost in between
+        self.bot.schedule(utils.listen(
+            self.bot, checks.STAFF_CHANNEL, checks.staff_cache.update,
+            on_subscribe=lambda: checks.staff_cache.load(self.bot.db)
+        ))
+
+    @wkr.Module.task(minutes=60)
+    async def staff_task(self):
+        # Resync in case a change got lost
+        await checks.staff_cache.load(self.bot.db)
+
     @wkr.Module.command(hidden=True)
     @wkr.is_bot_owner
     async def eval(self, ctx, *, expression):
@@ -192,6 +201,7 @@ class Admin(wkr.Module):
                               f"Choose from {', '.join([l.name.lower() for l in checks.StaffLevel])}.")
 
         await ctx.bot.db.staff.update_one({"_id": user.id}, {"$set": {"level": level.value}}, upsert=True)
+        await ctx.bot.redis.publish(checks.STAFF_CHANNEL, f"add:{user.id}:{level.value}")
         raise ctx.f.SUCCESS(f"Successfully **added `{user}` to the staff list**.")
 
     @staff.command(keep_checks=False, aliases=("rm",))
@@ -213,6 +223,7 @@ class Admin(wkr.Module):
         user = await user(ctx)
         result = await ctx.bot.db.staff.delete_one({"_id": user.id})
         if result.deleted_count > 0:
+            await ctx.bot.redis.publish(checks.STAFF_CHANNEL, f"remove:{user.id}")
             raise ctx.f.SUCCESS(f"Successfully **removed `{user}` from the staff list**.")
 
         else:
@@ -232,4 +243,5 @@ class Admin(wkr.Module):
     async def stop(self, ctx, guild_id=None):
         guild_id = guild_id or ctx.guild_id
         await ctx.bot.redis.delete(f"loaders:{guild_id}")
+        await ctx.bot.redis.publish(f"loaders:cancel:{guild_id}", "cancel")
         raise ctx.f.SUCCESS(f"**Cancelled loader** on guild `{guild_id}`.")
@@ -1,46 +1,87 @@
 import xenon_worker as wkr
 import utils
+import checks
 import asyncio
 import pymongo
-from pymongo import errors as mongoerrors
+import traceback
 from datetime import datetime, timedelta
-import random
+from os import environ as env
 
 from backups import BackupSaver, BackupLoader
+import storage
 
 
 MAX_BACKUPS = 15
 
+# How many interval backups a single worker runs at the same time
+INTERVAL_CONCURRENCY = int(env.get("INTERVAL_CONCURRENCY", 3))
+# Claimed intervals are released again if the worker doesn't finish them in time
+INTERVAL_LEASE = timedelta(minutes=30)
+# Failed interval backups are retried with an exponential backoff
+INTERVAL_RETRY = timedelta(minutes=5)
+INTERVAL_MAX_FAILURES = 5
 
-class BackupListMenu(wkr.ListMenu):
+
+def _snapshot_ref(backup_id):
+    """
+    Ids of interval backups can point to an older snapshot, `<id>~1` is the one before the latest
+    """
+    backup_id, _, older = backup_id.partition("~")
+    return backup_id, int(older) if older.isdigit() else 0
+
+
+class BackupListMenu(utils.KeysetListMenu):
     embed_kwargs = {"title": "Your Backups"}
+    sort = [("timestamp", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]
 
     async def get_items(self):
-        args = {
-            "limit": 10,
-            "skip": self.page * 10,
-            "sort": [("timestamp", pymongo.DESCENDING)],
-            "filter": {
-                "creator": self.ctx.author.id,
-            }
-        }
-        backups = self.ctx.bot.db.backups.find(**args)
+        backups = await self.find(
+            self.ctx.bot.db.backups,
+            {"creator": self.ctx.author.id},
+            # Only the header, not the backup data
+            projection=("name", "timestamp", "interval", "data.name")
+        )
         items = []
-        async for backup in backups:
+        for backup in backups:
             items.append((
                 backup["_id"] + (" ⏲️" if backup.get("interval") else ""),
-                f"{backup['data']['name']} (`{utils.datetime_to_string(backup['timestamp'])} UTC`)"
+                f"{storage.backup_name(backup)} (`{utils.datetime_to_string(backup['timestamp'])} UTC`)"
             ))
 
         return items
 
 
 class Backups(wkr.Module):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._interval_workers = 0
+        self.interval_stats = {
+            "claimed": 0,
+            "succeeded": 0,
+            "failed": 0,
+            "last_lag": timedelta(),
+            "max_lag": timedelta()
+        }
+
     @wkr.Module.listener()
     async def on_load(self, *_, **__):
+        await self.bot.db.intervals.create_index([("next", pymongo.ASCENDING)])
+        await self._rebalance_intervals()
         await self.bot.db.backups.create_index([("creator", pymongo.ASCENDING)])
+        await self.bot.db.backups.create_index([
+            ("creator", pymongo.ASCENDING),
+            ("timestamp", pymongo.DESCENDING),
+            ("_id", pymongo.DESCENDING)
+        ])
         await self.bot.db.backups.create_index([("timestamp", pymongo.ASCENDING)])
         await self.bot.db.backups.create_index([("data.id", pymongo.ASCENDING)])
+        await self.bot.db.bans.create_index([("backup", pymongo.ASCENDING), ("index", pymongo.ASCENDING)])
+        await self.bot.db.snapshots.create_index([("backup", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)])
+        await self.bot.db.backup_chunks.create_index([
+            ("backup", pymongo.ASCENDING),
+            ("version", pymongo.ASCENDING),
+            ("index", pymongo.ASCENDING)
+        ])
 
     @wkr.Module.command(aliases=("backups", "bu"))
     async def backup(self, ctx):
@@ -74,23 +115,21 @@ class Backups(wkr.Module):
             )
 
         status_msg = await ctx.f_send("**Creating Backup** ...", f=ctx.f.WORKING)
+
+        async def _progress(status):
+            await ctx.client.edit_message(status_msg, **ctx.f.format(f"**Creating Backup** ... ({status})",
+                                                                     f=ctx.f.WORKING))
+
+        backup_id = utils.unique_id()
         guild = await ctx.get_full_guild()
-        backup = BackupSaver(ctx.client, guild)
+        backup = BackupSaver(ctx.client, guild, backup_id=backup_id, progress=_progress)
         await backup.save()
 
-        backup_id = utils.unique_id()
-        try:
-            await ctx.bot.db.backups.insert_one({
-                "_id": backup_id,
-                "creator": ctx.author.id,
-                "timestamp": datetime.utcnow(),
-                "data": backup.data
-            })
-        except mongoerrors.DocumentTooLarge:
-            raise ctx.f.ERROR(
-                f"This backups **exceeds** the maximum size of **16 Megabyte**. Your server probably has a lot of "
-                f"members and channels containing messages. Try to create a new backup with less messages (chatlog)."
-            )
+        await storage.store_backup(
+            ctx.bot.db, backup_id, backup.data,
+            creator=ctx.author.id,
+            timestamp=datetime.utcnow()
+        )
 
         embed = ctx.f.format(f"Successfully **created backup** with the id `{backup_id}`.", f=ctx.f.SUCCESS)["embed"]
         embed.setdefault("fields", []).append({
@@ -123,40 +162,87 @@ class Backups(wkr.Module):
         Default options: ```{b.prefix}backup load oj1xky11871fzrbu```
         Only roles: ```{b.prefix}backup load oj1xky11871fzrbu !* roles```
         Everything but bans: ```{b.prefix}backup load oj1xky11871fzrbu !bans```
+        Only apply what changed: ```{b.prefix}backup load oj1xky11871fzrbu reconcile```
+        Continue an interrupted load: ```{b.prefix}backup load oj1xky11871fzrbu --resume```
+        The interval backup before the latest: ```{b.prefix}backup load oj1xky11871fzrbu~1```
         """
+        backup_id, older = _snapshot_ref(backup_id)
         backup_d = await ctx.client.db.backups.find_one({"_id": backup_id, "creator": ctx.author.id})
         if backup_d is None:
             raise ctx.f.ERROR(f"You have **no backup** with the id `{backup_id}`.")
 
-        warning_msg = await ctx.f_send("Are you sure that you want to load this backup?\n"
-                                       f"Please put the managed role called `{ctx.bot.user.name}` above all other "
-                                       f"roles before clicking the ✅ reaction.\n\n"
-                                       "__**All channels and roles will get replaced!**__\n\n"
-                                       "*Also keep in mind that you can only load up to 250 roles per day.*", f=ctx.f.WARNING)
-        reactions = ("✅", "❌")
-        for reaction in reactions:
-            await ctx.client.add_reaction(warning_msg, reaction)
+        if older:
+            snapshot = await storage.find_snapshot(ctx.bot.db, backup_id, older)
+            if snapshot is None:
+                raise ctx.f.ERROR(f"The backup `{backup_id}` has **no snapshot** `~{older}`.")
+
+            backup_data = await storage.load_snapshot(ctx.bot.db, snapshot["_id"])
+            version = snapshot["_id"]
+
+        else:
+            backup_data = await storage.load_backup_data(ctx.bot.db, backup_d)
+            # Interval backups keep their id, the stored version tells them apart
+            version = backup_d.get("snapshot") or backup_d.get("storage", {}).get("checksum") or backup_d.get("timestamp")
+
+        options = utils.backup_options(options)
+        resume = options.pop("resume", False)
+
+        async def _prepare():
+            guild = await ctx.get_full_guild()
+            backup = BackupLoader(ctx.client, guild, backup_data, reason="Backup loaded by " + str(ctx.author),
+                                  backup_id=backup_d["_id"], source=f"backup:{backup_d['_id']}:{version}")
+            if resume:
+                plan = await backup.restore_plan()
+                if plan is None:
+                    raise ctx.f.ERROR("There is **no interrupted loader** of this backup that could be resumed.")
+
+            else:
+                plan = await backup.create_plan(**options)
+
+            return backup, plan
+
+        backup, plan = await _prepare()
+        changed = False
+        while True:
+            warning_msg = await ctx.f_send(("**The server changed, this is the updated plan.**\n\n" if changed else "")
+                                           + "Are you sure that you want to load this backup?\n"
+                                           f"Please put the managed role called `{ctx.bot.user.name}` above all other "
+                                           f"roles before clicking the ✅ reaction.\n\n"
+                                           + ("__**Only what differs from the guild will get changed.**__\n\n"
+                                              if options.get("reconcile") else
+                                              "__**All channels and roles will get replaced!**__\n\n")
+                                           + "*Also keep in mind that you can only load up to 250 roles per day.*\n\n"
+                                           + plan.summary(), f=ctx.f.WARNING)
+            reactions = ("✅", "❌")
+            for reaction in reactions:
+                await ctx.client.add_reaction(warning_msg, reaction)
+
+            try:
+                data, = await ctx.client.wait_for(
+                    "message_reaction_add",
+                    ctx.shard_id,
+                    check=lambda d: d["message_id"] == warning_msg.id and
+                                    d["user_id"] == ctx.author.id and
+                                    d["emoji"]["name"] in reactions,
+                    timeout=60
+                )
+            except asyncio.TimeoutError:
+                await ctx.client.delete_message(warning_msg)
+                return
 
-        try:
-            data, = await ctx.client.wait_for(
-                "message_reaction_add",
-                ctx.shard_id,
-                check=lambda d: d["message_id"] == warning_msg.id and
-                                d["user_id"] == ctx.author.id and
-                                d["emoji"]["name"] in reactions,
-                timeout=60
-            )
-        except asyncio.TimeoutError:
             await ctx.client.delete_message(warning_msg)
-            return
+            if data["emoji"]["name"] != "✅":
+                return
 
-        await ctx.client.delete_message(warning_msg)
-        if data["emoji"]["name"] != "✅":
-            return
+            # The guild might have changed while the plan was shown, only the plan that was confirmed gets run
+            confirmed = plan
+            backup, plan = await _prepare()
+            if plan.to_dict() == confirmed.to_dict():
+                break
 
-        guild = await ctx.get_full_guild()
-        backup = BackupLoader(ctx.client, guild, backup_d["data"], reason="Backup loaded by " + str(ctx.author))
-        await backup.load(**utils.backup_options(options))
+            changed = True
+
+        await backup.load(plan)
 
     @backup.command(aliases=("del", "remove", "rm"))
     @wkr.cooldown(5, 30)
@@ -174,6 +260,7 @@ class Backups(wkr.Module):
         """
         result = await ctx.client.db.backups.delete_one({"_id": backup_id, "creator": ctx.author.id})
         if result.deleted_count > 0:
+            await storage.delete_backups(ctx.client.db, [backup_id])
             raise ctx.f.SUCCESS("Successfully **deleted backup**.")
 
         else:
@@ -214,7 +301,12 @@ class Backups(wkr.Module):
         if data["emoji"]["name"] != "✅":
             return
 
+        backup_ids = [
+            backup["_id"]
+            async for backup in ctx.client.db.backups.find({"creator": ctx.author.id}, projection=("_id",))
+        ]
         await ctx.client.db.backups.delete_many({"creator": ctx.author.id})
+        await storage.delete_backups(ctx.client.db, backup_ids)
         raise ctx.f.SUCCESS("Successfully **deleted all your backups**.")
 
     @backup.command(aliases=("ls",))
@@ -246,26 +338,50 @@ class Backups(wkr.Module):
         __Examples__
 
         ```{b.prefix}backup info 3zpssue46g```
+        ```{b.prefix}backup info 3zpssue46g~1```
         """
-        backup = await ctx.client.db.backups.find_one({"_id": backup_id, "creator": ctx.author.id})
+        backup_id, older = _snapshot_ref(backup_id)
+        backup = await ctx.client.db.backups.find_one(
+            {"_id": backup_id, "creator": ctx.author.id},
+            projection=("name", "timestamp", "summary", "data.name")
+        )
         if backup is None:
             raise ctx.f.ERROR(f"You have **no backup** with the id `{backup_id}`.")
 
-        backup["data"].pop("members", None)
-        guild = wkr.Guild(backup["data"])
+        if older:
+            snapshot = await storage.find_snapshot(ctx.bot.db, backup_id, older)
+            if snapshot is None:
+                raise ctx.f.ERROR(f"The backup `{backup_id}` has **no snapshot** `~{older}`.")
+
+            backup["timestamp"] = snapshot["timestamp"]
+            key = ("snapshot", snapshot["_id"])
+            preview = utils.cached_preview(key)
+            if preview is None:
+                data = await storage.load_snapshot(ctx.bot.db, snapshot["_id"])
+                preview = utils.guild_preview(key, data)
 
-        channels = utils.channel_tree(guild.channels)
-        if len(channels) > 1024:
-            channels = channels[:1000] + "\n...\n```"
+            name = storage.backup_name(backup)
+            channels, roles = preview
+
+        elif "summary" in backup:
+            name = backup["name"]
+            channels = backup["summary"]["channels"]
+            roles = backup["summary"]["roles"]
+
+        else:
+            # Backups from before the summaries were stored
+            name = storage.backup_name(backup)
+            key = ("backup", backup_id, backup["timestamp"])
+            preview = utils.cached_preview(key)
+            if preview is None:
+                backup = await ctx.client.db.backups.find_one({"_id": backup_id})
+                data = await storage.load_backup_data(ctx.bot.db, backup)
+                preview = utils.guild_preview(key, data)
 
-        roles = "```{}```".format("\n".join([
-            r.name for r in sorted(guild.roles, key=lambda r: r.position, reverse=True)
-        ]))
-        if len(roles) > 1024:
-            roles = roles[:1000] + "\n...\n```"
+            channels, roles = preview
 
         raise ctx.f.DEFAULT(embed={
-            "title": guild.name,
+            "title": name,
             "fields": [
                 {
                     "name": "Created At",
@@ -285,6 +401,38 @@ class Backups(wkr.Module):
             ]
         })
 
+    @backup.command(aliases=("h",))
+    @wkr.cooldown(5, 30)
+    async def history(self, ctx, backup_id):
+        """
+        List the kept snapshots of an interval backup
+
+
+        __Arguments__
+
+        **backup_id**: The id of the interval backup
+
+
+        __Examples__
+
+        ```{b.prefix}backup history 3zpssue46g```
+        """
+        backup = await ctx.client.db.backups.find_one({"_id": backup_id, "creator": ctx.author.id}, projection=("_id",))
+        if backup is None:
+            raise ctx.f.ERROR(f"You have **no backup** with the id `{backup_id}`.")
+
+        snapshots = await storage.list_snapshots(ctx.bot.db, backup_id)
+        if not snapshots:
+            raise ctx.f.ERROR(f"The backup `{backup_id}` has **no older snapshots**.")
+
+        raise ctx.f.DEFAULT(embed={
+            "title": "Snapshots",
+            "description": "\n".join(
+                f"`{backup_id}~{older}` ({utils.datetime_to_string(snapshot['timestamp'])} UTC)"
+                for older, snapshot in enumerate(snapshots)
+            )
+        })
+
     @backup.command(aliases=("iv",))
     @wkr.guild_only
     @wkr.has_permissions(administrator=True)
@@ -373,17 +521,22 @@ class Backups(wkr.Module):
         hours = max(hours, 24)
 
         now = datetime.utcnow()
-        td = timedelta(hours=hours)
-        await ctx.bot.db.intervals.update_one({"_id": ctx.guild_id}, {"$set": {
-            "_id": ctx.guild_id,
-            "last": now,
-            "next": now,
-            "interval": hours
-        }}, upsert=True)
+        next_run = utils.interval_slot(ctx.guild_id, hours, now)
+        await ctx.bot.db.intervals.update_one({"_id": ctx.guild_id}, {
+            "$set": {
+                "_id": ctx.guild_id,
+                "last": now,
+                "next": next_run,
+                "interval": hours,
+                "slotted": True
+            },
+            "$unset": {"failures": ""}
+        }, upsert=True)
 
+        td = next_run.replace(microsecond=0) - now.replace(microsecond=0)
         raise ctx.f.SUCCESS("Successful **enabled the backup interval**.\nThe first backup will be created in "
                             f"`{utils.timedelta_to_string(td)}` "
-                            f"at `{utils.datetime_to_string(datetime.utcnow() + td)} UTC`.")
+                            f"at `{utils.datetime_to_string(next_run)} UTC`.")
 
     @interval.command(aliases=["disable"])
     @wkr.cooldown(1, 10, bucket=wkr.CooldownType.GUILD)
@@ -408,23 +561,148 @@ class Backups(wkr.Module):
         if guild is None:
             return
 
-        backup = BackupSaver(self.bot, guild)
+        backup = BackupSaver(self.bot, guild, backup_id=guild_id)
         await backup.save()
 
-        await self.bot.db.backups.replace_one({"_id": guild_id}, {
-            "_id": guild_id,
-            "creator": guild.owner_id,
-            "timestamp": datetime.utcnow(),
-            "interval": True,
-            "data": backup.data
-        }, upsert=True)
+        await storage.store_snapshot(
+            self.bot.db, guild_id, backup.data,
+            creator=guild.owner_id,
+            timestamp=datetime.utcnow(),
+            interval=True
+        )
+
+    async def _claim_interval(self):
+        """
+        Atomically lease the most overdue interval, so no other worker picks it up
+        """
+        now = datetime.utcnow()
+        interval = await self.bot.db.intervals.find_one_and_update(
+            {"next": {"$lte": now}, "lease": {"$not": {"$gt": now}}},
+            {"$set": {"lease": now + INTERVAL_LEASE}},
+            sort=[("next", pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        if interval is not None:
+            lag = now - interval["next"]
+            self.interval_stats["claimed"] += 1
+            self.interval_stats["last_lag"] = lag
+            self.interval_stats["max_lag"] = max(self.interval_stats["max_lag"], lag)
+
+        return interval
+
+    async def _run_interval(self, interval):
+        guild_id = interval["_id"]
+        try:
+            await self.run_interval_backups(guild_id)
+
+        except Exception:
+            traceback.print_exc()
+            self.interval_stats["failed"] += 1
+
+            now = datetime.utcnow()
+            failures = interval.get("failures", 0) + 1
+            if failures < INTERVAL_MAX_FAILURES:
+                update = {"$set": {"next": now + INTERVAL_RETRY * 2 ** (failures - 1), "failures": failures}}
+
+            else:
+                # Give up until the next regular backup
+                update = {
+                    "$set": {"next": utils.interval_slot(guild_id, interval["interval"], now)},
+                    "$unset": {"failures": ""}
+                }
+
+        else:
+            self.interval_stats["succeeded"] += 1
+
+            now = datetime.utcnow()
+            update = {
+                "$set": {"next": utils.interval_slot(guild_id, interval["interval"], now), "last": now},
+                "$unset": {"failures": ""}
+            }
 
-    @wkr.Module.task(minutes=random.randint(5, 15))
+        update.setdefault("$unset", {})["lease"] = ""
+        # The lease might have expired and been taken over by another worker
+        await self.bot.db.intervals.update_one({"_id": guild_id, "lease": interval["lease"]}, update)
+
+    async def _rebalance_intervals(self):
+        """
+        Move intervals that were enabled before the time slots into their slot,
+        overdue ones stay due and only get their slot with the next run
+        """
+        now = datetime.utcnow()
+        updates = []
+        intervals = self.bot.db.intervals.find({"slotted": {"$ne": True}}, projection=("interval", "next"))
+        async for interval in intervals:
+            slot = utils.interval_slot(interval["_id"], interval["interval"], now)
+            current = interval.get("next")
+            updates.append(pymongo.UpdateOne({"_id": interval["_id"]}, {"$set": {
+                "next": min(current, slot) if current is not None else slot,
+                "slotted": True
+            }}))
+            if len(updates) >= 1000:
+                await self.bot.db.intervals.bulk_write(updates, ordered=False)
+                updates = []
+
+        if updates:
+            await self.bot.db.intervals.bulk_write(updates, ordered=False)
+
+    async def _interval_worker(self):
+        try:
+            while True:
+                interval = await self._claim_interval()
+                if interval is None:
+                    return
+
+                await self._run_interval(interval)
+
+        finally:
+            self._interval_workers -= 1
+
+    @wkr.Module.task(minutes=1)
     async def interval_task(self):
-        to_backup = self.bot.db.intervals.find({"next": {"$lt": datetime.utcnow()}})
-        async for interval in to_backup:
-            guild_id = interval["_id"]
-            self.bot.schedule(self.run_interval_backups(guild_id))
-            await self.bot.db.intervals.update_one({"_id": guild_id}, {"$set": {
-                "next": interval["next"] + timedelta(hours=interval["interval"])
-            }})
+        # Every worker only claims as many intervals as it can run
+        while self._interval_workers < INTERVAL_CONCURRENCY:
+            self._interval_workers += 1
+            self.bot.schedule(self._interval_worker())
+
+    @interval.command(hidden=True)
+    @checks.is_staff()
+    async def stats(self, ctx):
+        now = datetime.utcnow()
+        due = await ctx.bot.db.intervals.count_documents({"next": {"$lte": now}, "lease": {"$not": {"$gt": now}}})
+        leased = await ctx.bot.db.intervals.count_documents({"lease": {"$gt": now}})
+        oldest = await ctx.bot.db.intervals.find_one(
+            {"next": {"$lte": now}, "lease": {"$not": {"$gt": now}}},
+            sort=[("next", pymongo.ASCENDING)],
+            projection=("next",)
+        )
+        queue_lag = now - oldest["next"] if oldest is not None else timedelta()
+
+        stats = self.interval_stats
+        raise ctx.f.INFO(embed={
+            "title": "Interval Backups",
+            "fields": [
+                {
+                    "name": "Queue",
+                    "value": f"{due} due, {leased} running",
+                    "inline": True
+                },
+                {
+                    "name": "Queue Lag",
+                    "value": utils.timedelta_to_string(queue_lag),
+                    "inline": True
+                },
+                {
+                    "name": "This Worker",
+                    "value": f"{self._interval_workers}/{INTERVAL_CONCURRENCY} workers, "
+                             f"{stats['claimed']} claimed, {stats['succeeded']} succeeded, {stats['failed']} failed",
+                    "inline": False
+                },
+                {
+                    "name": "Claim Lag",
+                    "value": f"last {utils.timedelta_to_string(stats['last_lag'])}, "
+                             f"max {utils.timedelta_to_string(stats['max_lag'])}",
+                    "inline": False
+                }
+            ]
+        })
@@ -1,30 +1,25 @@
 import xenon_worker as wkr
 import pymongo
+from collections import OrderedDict
 from datetime import datetime
 
 import checks
 import utils
 
 
-class BlackListMenu(wkr.ListMenu):
+class BlackListMenu(utils.KeysetListMenu):
     embed_kwargs = {"title": "Blacklisted Users"}
+    sort = [("timestamp", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]
 
     async def get_items(self):
-        args = {
-            "limit": 10,
-            "skip": self.page * 10,
-            "sort": [("timestamp", pymongo.DESCENDING)],
-            "filter": {}
-        }
-        blacklist = self.ctx.bot.db.blacklist.find(**args)
+        blacklist = await self.find(self.ctx.bot.db.blacklist, {})
+        names = await utils.resolve_users(self.ctx.client, [entry["_id"] for entry in blacklist])
         items = []
-        async for entry in blacklist:
-            try:
-                user = await self.ctx.client.fetch_user(entry["_id"])
-            except wkr.NotFound:
-                name = entry["_id"]
+        for entry in blacklist:
+            if entry["_id"] in names:
+                name = f"{names[entry['_id']]} ({entry['_id']})"
             else:
-                name = f"{user} ({user.id})"
+                name = entry["_id"]
 
             items.append((
                 name,
@@ -34,21 +29,91 @@ class BlackListMenu(wkr.ListMenu):
         return items
 
 
-async def is_blacklisted(ctx, *args, **kwargs):
-    entry = await ctx.bot.db.blacklist.find_one({"_id": ctx.author.id})
-    if entry is None:
-        return True
-
-    raise ctx.f.ERROR(f"You are **no longer allowed to use this bot** for the following reason:\n"
-                      f"```{entry['reason']}```")
+# Changes to the blacklist are published here, so every worker can update its filter
+BLACKLIST_CHANNEL = "blacklist:updates"
+BLACKLIST_CACHE_SIZE = 1000
 
 
 class Blacklist(wkr.Module):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._filter = None
+        # Ids that were added while filters were rebuilt, one set per rebuild
+        self._added = []
+        # Recently checked users that passed the filter, includes false positives
+        self._entries = OrderedDict()
+        self._generation = 0
+
     @wkr.Module.listener()
     async def on_load(self, *_, **__):
+        await self.bot.db.blacklist.create_index([("timestamp", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
         # Add the top level blacklist check
-        await self.bot.db.backups.create_index([("timestamp", pymongo.ASCENDING)])
-        self.client.add_check(wkr.Check(is_blacklisted))
+        self.client.add_check(wkr.Check(self.is_blacklisted))
+
+        # The filter is built after subscribing, so no change gets lost in between
+        self.bot.schedule(utils.listen(self.bot, BLACKLIST_CHANNEL, self._on_update, on_subscribe=self._build_filter))
+
+    @wkr.Module.task(minutes=60)
+    async def rebuild_task(self):
+        # Removed ids stay in the filter until it gets rebuilt
+        await self._build_filter()
+
+    async def _build_filter(self):
+        added = set()
+        self._added.append(added)
+        try:
+            count = await self.bot.db.blacklist.estimated_document_count()
+            bloom = utils.BloomFilter(capacity=count * 2 + 1000)
+            async for entry in self.bot.db.blacklist.find({}, projection=("_id",)):
+                bloom.add(entry["_id"])
+
+            for user_id in added:
+                bloom.add(user_id)
+
+            self._filter = bloom
+            # Cached entries might be outdated if a change was missed
+            self._generation += 1
+            self._entries.clear()
+
+        finally:
+            self._added.remove(added)
+
+    async def _on_update(self, message):
+        action, user_id = message.split(":", 1)
+        self._generation += 1
+        self._entries.pop(user_id, None)
+        if action == "add":
+            if self._filter is not None:
+                self._filter.add(user_id)
+
+            for added in self._added:
+                added.add(user_id)
+
+    async def _get_entry(self, user_id):
+        if self._filter is not None and user_id not in self._filter:
+            return None
+
+        if user_id in self._entries:
+            self._entries.move_to_end(user_id)
+            return self._entries[user_id]
+
+        generation = self._generation
+        entry = await self.bot.db.blacklist.find_one({"_id": user_id})
+        if generation == self._generation:
+            # Don't cache the entry if the blacklist changed in the meantime
+            self._entries[user_id] = entry
+            if len(self._entries) > BLACKLIST_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+        return entry
+
+    async def is_blacklisted(self, ctx, *args, **kwargs):
+        entry = await self._get_entry(ctx.author.id)
+        if entry is None:
+            return True
+
+        raise ctx.f.ERROR(f"You are **no longer allowed to use this bot** for the following reason:\n"
+                          f"```{entry['reason']}```")
 
     @wkr.Module.command(hidden=True, aliases=("bl",))
     @checks.is_staff(level=checks.StaffLevel.MOD)
@@ -91,6 +156,7 @@ class Blacklist(wkr.Module):
             "staff": ctx.author.id,
             "reason": reason
         }, upsert=True)
+        await ctx.bot.redis.publish(BLACKLIST_CHANNEL, f"add:{user.id}")
         raise ctx.f.SUCCESS(f"Successfully **added {user.mention} to the blacklist**.")
 
     @blacklist.command(aliases=("rm",))
@@ -100,4 +166,5 @@ class Blacklist(wkr.Module):
         if result.deleted_count == 0:
             raise ctx.f.ERROR(f"{user.mention} **is not on the blacklist**.")
 
+        await ctx.bot.redis.publish(BLACKLIST_CHANNEL, f"remove:{user.id}")
         raise ctx.f.SUCCESS(f"Successfully **removed {user.mention} from the blacklist**.")
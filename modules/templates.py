@@ -1,42 +1,75 @@
 import xenon_worker as wkr
 import utils
 import asyncio
+import msgpack
 import pymongo
 import pymongo.errors
 from datetime import datetime
 from os import environ as env
 
 from backups import BackupSaver, BackupLoader
+from search_index import TemplateIndex
+from template_cache import TemplateCache, template_version
 import checks
 
 
-class TemplateListMenu(wkr.ListMenu):
+# Changes to the approved templates are published here, so every worker can update its search index
+TEMPLATE_CHANNEL = "templates:updates"
+
+# Discord templates are cached, templates that don't exist for a shorter time
+CROSSLOAD_TTL = 60 * 60
+CROSSLOAD_MISSING_TTL = 5 * 60
+
+# Template uses are counted here and regularly added to the database,
+# outside of the templates: namespace that holds one key per template name
+USES_KEY = "template_uses"
+
+
+class TemplateListMenu(utils.KeysetListMenu):
     embed_kwargs = {
         "title": "Template List",
         "description": "You can find more and more recent template on https://templates.xenon.bot/"
     }
+    sort = [("featured", pymongo.DESCENDING), ("uses", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]
 
-    def __init__(self, ctx, search):
+    def __init__(self, ctx, search, index=None):
         super().__init__(ctx)
         self.search = search.strip()
+        self.index = index
+        self._results = None
 
     async def get_items(self):
-        args = {
-            "limit": 10,
-            "skip": self.page * 10,
-            "sort": [("featured", pymongo.DESCENDING), ("uses", pymongo.DESCENDING)],
-            "filter": {
-                "approved": True
-            }
+        if self.search != "" and self.index is not None:
+            if self._results is None:
+                self._results = self.index.search(self.search)
+
+            items = []
+            for name in self._results[self.page * 10:(self.page + 1) * 10]:
+                template = self.index.templates.get(name)
+                if template is None:
+                    continue
+
+                items.append((
+                    name + ("  🌟" if template["featured"] else ""),
+                    template.get("description") or "No Description"
+                ))
+
+            return items
+
+        filter = {
+            "approved": True
         }
         if self.search != "":
-            args["filter"]["$text"] = {
+            filter["$text"] = {
                 "$search": self.search
             }
 
-        templates = self.ctx.bot.db.templates.find(**args)
+        templates = await self.find(
+            self.ctx.bot.db.templates, filter,
+            projection=("featured", "uses", "description")
+        )
         items = []
-        async for template in templates:
+        for template in templates:
             items.append((
                 template["_id"] + ("  🌟" if template["featured"] else ""),
                 template.get("description") or "No Description"
@@ -52,12 +85,24 @@ class Templates(wkr.Module):
     APPROVAL_GUILD = env.get("TPL_APPROVAL_GUILD")
     APPROVAL_OPTIONS = {}
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.index = None
+        # Templates that changed while indexes were built, one set per build
+        self._changed = []
+        self.template_cache = TemplateCache(self.client)
+        # Crossloads that are currently in flight
+        self._crossloads = {}
+
     @wkr.Module.listener()
     async def on_load(self, *_, **__):
         await self.bot.db.templates.create_index([("_id", pymongo.TEXT), ("description", pymongo.TEXT)])
-        await self.bot.db.backups.create_index([("approved", pymongo.ASCENDING)])
-        await self.bot.db.backups.create_index([("featured", pymongo.ASCENDING)])
-        await self.bot.db.backups.create_index([("uses", pymongo.ASCENDING)])
+        await self.bot.db.templates.create_index([
+            ("approved", pymongo.ASCENDING),
+            ("featured", pymongo.DESCENDING),
+            ("uses", pymongo.DESCENDING),
+            ("_id", pymongo.DESCENDING)
+        ])
         # Subscribe to message_reaction_add on the approval guild
         # shard_id = await self.client.guild_shard(self.APPROVAL_GUILD)
         # await self.bot.subscribe(f"{shard_id}.message_reaction_add", shared=True)
@@ -70,18 +115,137 @@ class Templates(wkr.Module):
                                        "Templates are for everyone, not specifically for you, they must be generic.")
         }
 
+        # The index is built after subscribing, so no change gets lost in between
+        self.bot.schedule(utils.listen(self.bot, TEMPLATE_CHANNEL, self._on_update, on_subscribe=self._build_index))
+
+    @wkr.Module.task(minutes=60)
+    async def index_task(self):
+        # Templates are also approved and edited through the website
+        await self._build_index()
+
+    @wkr.Module.task(minutes=1)
+    async def uses_task(self):
+        # Take the counts and reset them in one step, so no use gets counted twice
+        tr = self.bot.redis.multi_exec()
+        counts = tr.hgetall(USES_KEY)
+        tr.delete(USES_KEY)
+        await tr.execute()
+
+        counts = {name.decode("utf-8"): int(count) for name, count in (await counts).items()}
+        if not counts:
+            return
+
+        try:
+            await self.bot.db.templates.bulk_write([
+                pymongo.UpdateOne({"_id": name}, {"$inc": {"uses": count}})
+                for name, count in counts.items()
+            ], ordered=False)
+
+        except pymongo.errors.PyMongoError:
+            # Put the counts back for the next flush
+            tr = self.bot.redis.multi_exec()
+            for name, count in counts.items():
+                tr.hincrby(USES_KEY, name, count)
+
+            await tr.execute()
+            raise
+
+        if self.index is not None:
+            for name, count in counts.items():
+                template = self.index.templates.get(name)
+                if template is not None:
+                    self.index.update(name, uses=template["uses"] + count)
+
+    async def _index_template(self, name):
+        template = await self.bot.db.templates.find_one(
+            {"_id": name, "approved": True},
+            projection=("description", "featured", "uses", "data.channels.name", "data.roles.name")
+        )
+        if template is None:
+            self.index.remove(name)
+
+        else:
+            self.index.add(template)
+
+    async def _build_index(self):
+        changed = set()
+        self._changed.append(changed)
+        try:
+            await self._load_index()
+            # Templates that changed while the index was built
+            for name in list(changed):
+                await self._index_template(name)
+
+        finally:
+            self._changed.remove(changed)
+
+    async def _load_index(self):
+        index = TemplateIndex()
+        templates = self.bot.db.templates.find(
+            {"approved": True},
+            projection=("description", "featured", "uses", "data.channels.name", "data.roles.name")
+        )
+        async for template in templates:
+            index.add(template)
+
+        self.index = index
+
+    async def _on_update(self, name):
+        self.template_cache.drop(name)
+        for changed in self._changed:
+            changed.add(name)
+
+        if self.index is not None:
+            await self._index_template(name)
+
+    async def _template_changed(self, name):
+        await self.template_cache.invalidate(name)
+        await self.bot.redis.publish(TEMPLATE_CHANNEL, name)
+
     async def _crossload_template(self, template_id):
         template_id = template_id.strip("/").split("/")[-1]
+        pending = self._crossloads.get(template_id)
+        if pending is None:
+            # Concurrent requests for the same template share one request
+            pending = self.client.schedule(self._fetch_crossload(template_id))
+            self._crossloads[template_id] = pending
+            pending.add_done_callback(lambda _: self._crossloads.pop(template_id, None))
+
+        return await asyncio.shield(pending)
+
+    async def _fetch_crossload(self, template_id):
+        cached = await self.client.redis.get(f"crossloads:{template_id}")
+        if cached is not None:
+            template = msgpack.unpackb(cached, raw=False)
+            if template is not None:
+                # Cached before the code was part of it
+                template.setdefault("code", template_id)
+
+            return template
+
+        template = await self._request_crossload(template_id)
+        await self.client.redis.setex(
+            f"crossloads:{template_id}",
+            CROSSLOAD_TTL if template is not None else CROSSLOAD_MISSING_TTL,
+            msgpack.packb(template, use_bin_type=True)
+        )
+        return template
+
+    async def _request_crossload(self, template_id):
         try:
             data = await self.client.http.request(wkr.Route("GET", "/guilds/templates/" + template_id))
             guild = data["serialized_source_guild"]
             return {
                 "_id": data["name"],
+                # Names aren't unique, the code is
+                "code": template_id,
                 "description": data["description"],
                 "creator": data["creator_id"],
                 "uses": data["usage_count"],
                 "approved": True,
                 "featured": False,
+                # Not stored in the database, the uses are counted by discord
+                "crossloaded": True,
                 "data": {
                     "id": 0,
                     "roles": [
@@ -182,53 +346,92 @@ class Templates(wkr.Module):
         Default options: ```{b.prefix}template load starter```
         Only roles: ```{b.prefix}template load starter !* roles```
         Everything but bans: ```{b.prefix}template load starter !bans```
+        Continue an interrupted load: ```{b.prefix}template load starter --resume```
         """
-        template = await ctx.client.db.templates.find_one({"_id": name})
+        template = await self.template_cache.get(name)
         if template is None:
             template = await self._crossload_template(name)
 
         if template is None:
             raise ctx.f.ERROR(f"There is **no template** with the name `{name}`.")
 
-        warning_msg = await ctx.f_send("Are you sure that you want to load this template?\n"
-                                       f"Please put the managed role called `{ctx.bot.user.name}` above all other "
-                                       f"roles before clicking the ✅ reaction.\n\n"
-                                       "__**All channels and roles will get replaced!**__\n\n"
-                                       "*Also keep in mind that you can only load up to 250 roles per day.*", f=ctx.f.WARNING)
+        if template.get("crossloaded"):
+            source = "crossload:" + template["code"]
 
-        reactions = ("✅", "❌")
-        for reaction in reactions:
-            await ctx.client.add_reaction(warning_msg, reaction)
+        else:
+            source = "template:" + template["_id"]
+
+        options = utils.backup_options(options)
+        resume = options.pop("resume", False)
+        options["settings"] = False
+
+        async def _prepare():
+            guild = await ctx.get_full_guild()
+            backup = BackupLoader(ctx.client, guild, template["data"], reason="Template loaded by " + str(ctx.author),
+                                  source=source)
+            if resume:
+                plan = await backup.restore_plan()
+                if plan is None:
+                    raise ctx.f.ERROR("There is **no interrupted loader** of this template that could be resumed.")
+
+            else:
+                plan = await backup.create_plan(**options)
+
+            return backup, plan
+
+        backup, plan = await _prepare()
+        changed = False
+        while True:
+            warning_msg = await ctx.f_send(("**The server changed, this is the updated plan.**\n\n" if changed else "")
+                                           + "Are you sure that you want to load this template?\n"
+                                           f"Please put the managed role called `{ctx.bot.user.name}` above all other "
+                                           f"roles before clicking the ✅ reaction.\n\n"
+                                           + ("__**Only what differs from the guild will get changed.**__\n\n"
+                                              if options.get("reconcile") else
+                                              "__**All channels and roles will get replaced!**__\n\n")
+                                           + "*Also keep in mind that you can only load up to 250 roles per day.*\n\n"
+                                           + plan.summary(), f=ctx.f.WARNING)
+
+            reactions = ("✅", "❌")
+            for reaction in reactions:
+                await ctx.client.add_reaction(warning_msg, reaction)
+
+            try:
+                data, = await ctx.client.wait_for(
+                    "message_reaction_add",
+                    ctx.shard_id,
+                    check=lambda d: d["message_id"] == warning_msg.id and
+                                    d["user_id"] == ctx.author.id and
+                                    d["emoji"]["name"] in reactions,
+                    timeout=60
+                )
+            except asyncio.TimeoutError:
+                await ctx.client.delete_message(warning_msg)
+                return
 
-        try:
-            data, = await ctx.client.wait_for(
-                "message_reaction_add",
-                ctx.shard_id,
-                check=lambda d: d["message_id"] == warning_msg.id and
-                                d["user_id"] == ctx.author.id and
-                                d["emoji"]["name"] in reactions,
-                timeout=60
-            )
-        except asyncio.TimeoutError:
             await ctx.client.delete_message(warning_msg)
-            return
+            if data["emoji"]["name"] != "✅":
+                return
 
-        await ctx.client.delete_message(warning_msg)
-        if data["emoji"]["name"] != "✅":
-            return
+            # The guild might have changed while the plan was shown, only the plan that was confirmed gets run
+            confirmed = plan
+            backup, plan = await _prepare()
+            if plan.to_dict() == confirmed.to_dict():
+                break
 
-        guild = await ctx.get_full_guild()
-        backup = BackupLoader(ctx.client, guild, template["data"], reason="Template loaded by " + str(ctx.author))
+            changed = True
+
+        if not template.get("crossloaded"):
+            await ctx.bot.redis.hincrby(USES_KEY, template["_id"], 1)
 
-        options = list(options)
-        options.append("!settings")
-        await backup.load(**utils.backup_options(options))
+        await backup.load(plan)
 
     @template.command(aliases=("del", "remove", "rm"))
     @wkr.cooldown(5, 30)
     async def delete(self, ctx, name):
         result = await ctx.client.db.templates.delete_one({"_id": name, "creator": ctx.author.id})
         if result.deleted_count > 0:
+            await self._template_changed(name)
             raise ctx.f.SUCCESS("Successfully **deleted template**.")
 
         else:
@@ -246,7 +449,7 @@ class Templates(wkr.Module):
         All templates: ```{b.prefix}template list```
         Search: ```{b.prefix}template search roleplay```
         """
-        menu = TemplateListMenu(ctx, search)
+        menu = TemplateListMenu(ctx, search, self.index)
         await menu.start()
 
     @template.command(aliases=("i",))
@@ -265,7 +468,7 @@ class Templates(wkr.Module):
 
         ```{b.prefix}template info starter```
         """
-        template = await ctx.client.db.templates.find_one({"_id": name})
+        template = await self.template_cache.get(name)
         if template is None:
             template = await self._crossload_template(name)
 
@@ -275,17 +478,13 @@ class Templates(wkr.Module):
         raise ctx.f.DEFAULT(embed=self._template_info(template))
 
     def _template_info(self, template):
-        guild = wkr.Guild(template["data"])
+        if template.get("crossloaded"):
+            key = ("crossload", template["code"])
 
-        channels = utils.channel_tree(guild.channels)
-        if len(channels) > 1024:
-            channels = channels[:1000] + "\n...\n```"
+        else:
+            key = ("template", template["_id"], template_version(template))
 
-        roles = "```{}```".format("\n".join([
-            r.name for r in sorted(guild.roles, key=lambda r: r.position, reverse=True)
-        ]))
-        if len(roles) > 1024:
-            roles = roles[:1000] + "\n...\n```"
+        channels, roles = utils.guild_preview(key, template["data"])
 
         return {
             "title": template["_id"] + (
@@ -318,6 +517,23 @@ class Templates(wkr.Module):
             ]
         }
 
+    @template.command(hidden=True)
+    @checks.is_staff(level=checks.StaffLevel.MOD)
+    async def cache(self, ctx):
+        stats = self.template_cache.stats
+        lookups = sum(stats.values()) or 1
+        raise ctx.f.INFO(embed={
+            "title": "Template Cache",
+            "fields": [
+                {
+                    "name": name.title(),
+                    "value": f"{count} ({count / lookups:.1%})",
+                    "inline": True
+                }
+                for name, count in stats.items()
+            ]
+        })
+
     @template.command(hidden=True)
     @checks.is_staff(level=checks.StaffLevel.MOD)
     async def approve(self, ctx, tpl_name):
@@ -386,6 +602,7 @@ class Templates(wkr.Module):
     def _delete_because(self, reason):
         async def predicate(template):
             await self.client.db.templates.delete_one({"_id": template["_id"]})
+            await self._template_changed(template["_id"])
             dm_channel = await self.client.start_dm(wkr.Snowflake(template["creator"]))
             await self.client.f_send(
                 dm_channel,
@@ -418,6 +635,7 @@ class Templates(wkr.Module):
         }})
         template["approved"] = True
         template["featured"] = True
+        await self._template_changed(template["_id"])
         dm_channel = await self.client.start_dm(wkr.Snowflake(template["creator"]))
         await self.client.f_send(
             dm_channel,
@@ -431,6 +649,7 @@ class Templates(wkr.Module):
             "approved": True
         }})
         template["approved"] = True
+        await self._template_changed(template["_id"])
         dm_channel = await self.client.start_dm(wkr.Snowflake(template["creator"]))
         await self.client.f_send(
             dm_channel,
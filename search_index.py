@@ -0,0 +1,209 @@
+import bisect
+import math
+import re
+from collections import Counter, defaultdict
+
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+# How much a match in each field counts towards the term frequency
+FIELD_WEIGHTS = {
+    "name": 3,
+    "description": 2,
+    "channels": 1,
+    "roles": 1
+}
+
+# Prefix and fuzzy matches count less than exact ones
+PREFIX_WEIGHT = 0.7
+FUZZY_WEIGHT = 0.4
+
+# Short prefixes would otherwise expand to a big part of the vocabulary
+PREFIX_TERMS = 100
+FUZZY_CANDIDATES = 50
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Popularity is blended into the relevance score
+USES_WEIGHT = 0.3
+FEATURED_BONUS = 1
+
+
+def tokenize(text):
+    return [token.replace("_", "") for token in TOKEN_RE.findall(text.lower()) if token.strip("_")]
+
+
+def _deletes(term):
+    """
+    The term with one character removed, terms within one typo share at least one of these (or the term itself)
+    """
+    return {term[:i] + term[i + 1:] for i in range(len(term))}
+
+
+def _within_distance(a, b, limit):
+    """
+    Levenshtein distance of a and b is at most limit
+    """
+    if abs(len(a) - len(b)) > limit:
+        return False
+
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+
+        if min(current) > limit:
+            return False
+
+        previous = current
+
+    return previous[-1] <= limit
+
+
+class TemplateIndex:
+    """
+    In-memory full-text index over the approved templates, ranked with BM25 and the template uses
+    """
+
+    def __init__(self):
+        self.templates = {}
+        self._postings = defaultdict(dict)
+        self._lengths = {}
+        self._total_length = 0
+        self._terms = []
+        self._terms_dirty = False
+        # deleted variant -> terms, finds typo candidates without scanning the vocabulary
+        self._variants = defaultdict(set)
+
+    def __len__(self):
+        return len(self.templates)
+
+    def add(self, template):
+        """
+        Add or replace a template, only reads the names of the channels and roles
+        """
+        name = template["_id"]
+        self.remove(name)
+
+        data = template.get("data", {})
+        frequencies = Counter()
+        fields = {
+            "name": name,
+            "description": template.get("description") or "",
+            "channels": " ".join(c.get("name", "") for c in data.get("channels", [])),
+            "roles": " ".join(r.get("name", "") for r in data.get("roles", []))
+        }
+        for field, text in fields.items():
+            for token in tokenize(text):
+                frequencies[token] += FIELD_WEIGHTS[field]
+
+        for term, frequency in frequencies.items():
+            if term not in self._postings:
+                self._terms_dirty = True
+                for variant in _deletes(term) | {term}:
+                    self._variants[variant].add(term)
+
+            self._postings[term][name] = frequency
+
+        length = sum(frequencies.values())
+        self._lengths[name] = length
+        self._total_length += length
+        self.templates[name] = {
+            "_id": name,
+            "description": template.get("description"),
+            "featured": template.get("featured", False),
+            "uses": template.get("uses", 0),
+            "terms": list(frequencies.keys())
+        }
+
+    def remove(self, name):
+        template = self.templates.pop(name, None)
+        if template is None:
+            return
+
+        for term in template["terms"]:
+            postings = self._postings[term]
+            postings.pop(name, None)
+            if not postings:
+                del self._postings[term]
+                self._terms_dirty = True
+                for variant in _deletes(term) | {term}:
+                    terms = self._variants[variant]
+                    terms.discard(term)
+                    if not terms:
+                        del self._variants[variant]
+
+        self._total_length -= self._lengths.pop(name)
+
+    def update(self, name, **fields):
+        template = self.templates.get(name)
+        if template is not None:
+            template.update(fields)
+
+    def _sorted_terms(self):
+        if self._terms_dirty:
+            self._terms = sorted(self._postings.keys())
+            self._terms_dirty = False
+
+        return self._terms
+
+    def _expand(self, token):
+        """
+        Terms matching the token exactly, by prefix or with a typo and how much they count
+        """
+        matches = {}
+        if token in self._postings:
+            matches[token] = 1
+
+        terms = self._sorted_terms()
+        end = min(bisect.bisect_left(terms, token) + PREFIX_TERMS, len(terms))
+        for i in range(bisect.bisect_left(terms, token), end):
+            if not terms[i].startswith(token):
+                break
+
+            matches.setdefault(terms[i], PREFIX_WEIGHT)
+
+        if not matches and len(token) > 3:
+            candidates = set()
+            for variant in _deletes(token) | {token}:
+                candidates.update(self._variants.get(variant, ()))
+                if len(candidates) >= FUZZY_CANDIDATES:
+                    break
+
+            # Shared variants also catch swapped characters, which are two edits apart
+            limit = 1 if len(token) <= 6 else 2
+            for term in candidates:
+                if _within_distance(token, term, limit):
+                    matches[term] = FUZZY_WEIGHT
+
+        return matches
+
+    def search(self, query):
+        """
+        Names of the matching templates, the most relevant first
+        """
+        count = len(self.templates)
+        if count == 0:
+            return []
+
+        average_length = self._total_length / count
+        scores = Counter()
+        for token in set(tokenize(query)):
+            for term, weight in self._expand(token).items():
+                postings = self._postings[term]
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for name, frequency in postings.items():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[name] / average_length)
+                    scores[name] += weight * idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+
+        def rank(name):
+            template = self.templates[name]
+            popularity = USES_WEIGHT * math.log1p(template["uses"])
+            if template["featured"]:
+                popularity += FEATURED_BONUS
+
+            return scores[name] + popularity
+
+        return sorted(scores.keys(), key=rank, reverse=True)
@@ -0,0 +1,363 @@
+import hashlib
+import zlib
+import msgpack
+import pymongo
+from collections import Counter
+from datetime import datetime
+from os import environ as env
+
+import utils
+import views
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# MongoDB documents can't be larger than 16 MB, the payload is split into chunks well below that
+CHUNK_SIZE = 1024 * 1024
+
+# How many interval snapshots are kept per guild
+SNAPSHOT_HISTORY = int(env.get("SNAPSHOT_HISTORY", 7))
+
+# Smaller blobs aren't worth compressing
+BLOB_COMPRESS_THRESHOLD = 1024
+
+# Lists like the members are split into pages, so a change only rewrites its page
+LIST_PAGE_ITEMS = 1000
+
+
+def compress(raw):
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=3).compress(raw)
+
+    return "zlib", zlib.compress(raw, 6)
+
+
+def decompress(codec, payload):
+    if codec is None:
+        return payload
+
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this backup")
+
+        return zstandard.ZstdDecompressor().decompress(payload)
+
+    return zlib.decompress(payload)
+
+
+def backup_counts(data):
+    return {
+        "roles": len(data.get("roles", [])),
+        "channels": len(data.get("channels", [])),
+        "members": len(data.get("members", [])),
+        "bans": len(data["bans"]) if "bans" in data else data.get("ban_count", 0)
+    }
+
+
+def backup_summary(data):
+    """
+    Pre-rendered previews, so listing or showing a backup doesn't require the data
+    """
+    guild = views.GuildView(data)
+    return {
+        "channels": utils.channel_tree(guild.channels, limit=utils.FIELD_LIMIT),
+        "roles": utils.role_list(guild.roles, limit=utils.FIELD_LIMIT)
+    }
+
+
+async def store_backup(db, backup_id, data, **fields):
+    """
+    Store the backup data compressed and in chunks,
+    the backup document itself is only a small header pointing to the chunks
+    """
+    raw = msgpack.packb(data, use_bin_type=True)
+    codec, payload = compress(raw)
+    checksum = hashlib.sha256(payload).hexdigest()
+
+    current = await db.backups.find_one({"_id": backup_id}, projection=("storage",))
+    if current is None or current.get("storage", {}).get("checksum") != checksum:
+        chunks = [payload[i:i + CHUNK_SIZE] for i in range(0, len(payload), CHUNK_SIZE)]
+        await db.backup_chunks.insert_many([
+            {
+                "backup": backup_id,
+                "version": checksum,
+                "index": i,
+                "data": chunk
+            }
+            for i, chunk in enumerate(chunks)
+        ])
+
+    header = {
+        "_id": backup_id,
+        "name": data["name"],
+        "guild_id": data["id"],
+        "counts": backup_counts(data),
+        "summary": backup_summary(data),
+        "storage": {
+            "codec": codec,
+            "checksum": checksum,
+            "chunks": (len(payload) + CHUNK_SIZE - 1) // CHUNK_SIZE,
+            "size": len(raw),
+            "compressed_size": len(payload)
+        },
+        **fields
+    }
+    await db.backups.replace_one({"_id": backup_id}, header, upsert=True)
+
+    # Readers switch to the new version with the header, the old chunks can go now
+    await db.backup_chunks.delete_many({"backup": backup_id, "version": {"$ne": checksum}})
+    return header
+
+
+async def load_backup_data(db, backup):
+    """
+    Get the data of a backup document, no matter how it's stored
+    """
+    if "data" in backup:
+        # Backups from before the chunked storage
+        return backup["data"]
+
+    if "snapshot" in backup:
+        return await load_snapshot(db, backup["snapshot"])
+
+    storage = backup["storage"]
+    chunks = db.backup_chunks.find(
+        {"backup": backup["_id"], "version": storage["checksum"]},
+        sort=[("index", 1)]
+    )
+    payload = b"".join([chunk["data"] async for chunk in chunks])
+    if hashlib.sha256(payload).hexdigest() != storage["checksum"]:
+        raise ValueError(f"The backup {backup['_id']} is corrupted")
+
+    return msgpack.unpackb(decompress(storage["codec"], payload), raw=False)
+
+
+def backup_name(backup):
+    if "data" in backup:
+        return backup["data"]["name"]
+
+    return backup["name"]
+
+
+async def delete_backups(db, backup_ids):
+    """
+    Remove everything that is stored next to the backup documents
+    """
+    await db.backup_chunks.delete_many({"backup": {"$in": backup_ids}})
+    await db.bans.delete_many({"backup": {"$in": backup_ids}})
+    await release_snapshots(db, {"backup": {"$in": backup_ids}})
+
+
+def _canonical(value):
+    if isinstance(value, dict):
+        return {key: _canonical(value[key]) for key in sorted(value)}
+
+    if isinstance(value, list):
+        return [_canonical(item) for item in value]
+
+    return value
+
+
+def split_snapshot(data):
+    """
+    Split backup data into content addressed blobs and a manifest referencing them,
+    roles, channels and permission overwrites each get their own blob,
+    other lists like the members are split into pages that stay below the chunk size
+    """
+    blobs = {}
+
+    def ref(value):
+        raw = msgpack.packb(_canonical(value), use_bin_type=True)
+        key = hashlib.sha256(raw).hexdigest()
+        blobs[key] = raw
+        return key
+
+    def pages(items):
+        refs = []
+        page = []
+        size = 0
+        for item in items:
+            item = _canonical(item)
+            item_size = len(msgpack.packb(item, use_bin_type=True))
+            if page and (len(page) >= LIST_PAGE_ITEMS or size + item_size > CHUNK_SIZE):
+                refs.append(ref(page))
+                page = []
+                size = 0
+
+            page.append(item)
+            size += item_size
+
+        if page:
+            refs.append(ref(page))
+
+        return refs
+
+    channels = []
+    for channel in data.get("channels", []):
+        channel = dict(channel)
+        channel["permission_overwrites"] = ref(channel.get("permission_overwrites", []))
+        channels.append(ref(channel))
+
+    base = {}
+    lists = {}
+    for key, value in data.items():
+        if key in ("roles", "channels"):
+            continue
+
+        if isinstance(value, list):
+            lists[key] = pages(value)
+
+        else:
+            base[key] = value
+
+    manifest = {
+        "base": ref(base),
+        "roles": [ref(role) for role in data.get("roles", [])],
+        "channels": channels,
+        "lists": lists
+    }
+    return manifest, blobs
+
+
+async def store_snapshot(db, backup_id, data, **fields):
+    """
+    Store the backup data as a snapshot of content addressed blobs,
+    unchanged roles, channels, overwrites and list pages are shared with the previous snapshots
+    """
+    manifest, blobs = split_snapshot(data)
+    version = hashlib.sha256(msgpack.packb(manifest, use_bin_type=True)).hexdigest()
+
+    latest = await db.snapshots.find_one(
+        {"backup": backup_id},
+        sort=[("timestamp", pymongo.DESCENDING)],
+        projection=("version",)
+    )
+    if latest is not None and latest["version"] == version:
+        # Nothing changed since the last snapshot
+        await db.backups.update_one({"_id": backup_id}, {"$set": fields})
+        return latest["_id"]
+
+    # Always upserted, a blob that looks shared might get released by another snapshot in the meantime
+    updates = []
+    for key, raw in blobs.items():
+        codec, payload = compress(raw) if len(raw) > BLOB_COMPRESS_THRESHOLD else (None, raw)
+        updates.append(pymongo.UpdateOne(
+            {"_id": key},
+            {"$setOnInsert": {"codec": codec, "data": payload}, "$inc": {"refs": 1}},
+            upsert=True
+        ))
+
+    await db.blobs.bulk_write(updates, ordered=False)
+    result = await db.snapshots.insert_one({
+        "backup": backup_id,
+        "version": version,
+        "timestamp": datetime.utcnow(),
+        "manifest": manifest,
+        "blobs": list(blobs.keys())
+    })
+
+    await db.backups.replace_one({"_id": backup_id}, {
+        "_id": backup_id,
+        "name": data["name"],
+        "guild_id": data["id"],
+        "counts": backup_counts(data),
+        "summary": backup_summary(data),
+        "snapshot": result.inserted_id,
+        **fields
+    }, upsert=True)
+
+    # The backup might have been stored in chunks before
+    await db.backup_chunks.delete_many({"backup": backup_id})
+
+    outdated = [
+        snapshot["_id"]
+        async for snapshot in db.snapshots.find(
+            {"backup": backup_id},
+            sort=[("timestamp", pymongo.DESCENDING)],
+            skip=SNAPSHOT_HISTORY,
+            projection=("_id",)
+        )
+    ]
+    if outdated:
+        await release_snapshots(db, {"_id": {"$in": outdated}})
+
+    return result.inserted_id
+
+
+async def load_snapshot(db, snapshot_id):
+    """
+    Reassemble the backup data of a snapshot from its blobs
+    """
+    snapshot = await db.snapshots.find_one({"_id": snapshot_id})
+    if snapshot is None:
+        raise ValueError(f"The snapshot {snapshot_id} doesn't exist")
+
+    blobs = {}
+    async for blob in db.blobs.find({"_id": {"$in": snapshot["blobs"]}}):
+        blobs[blob["_id"]] = msgpack.unpackb(decompress(blob["codec"], blob["data"]), raw=False)
+
+    if len(blobs) != len(snapshot["blobs"]):
+        raise ValueError(f"The snapshot {snapshot_id} is missing blobs")
+
+    manifest = snapshot["manifest"]
+    data = dict(blobs[manifest["base"]])
+    data["roles"] = [blobs[key] for key in manifest["roles"]]
+    data["channels"] = []
+    for key in manifest["channels"]:
+        channel = dict(blobs[key])
+        channel["permission_overwrites"] = blobs[channel["permission_overwrites"]]
+        data["channels"].append(channel)
+
+    # Snapshots from before the lists were paged have them in the base
+    for key, refs in manifest.get("lists", {}).items():
+        data[key] = [item for page in refs for item in blobs[page]]
+
+    return data
+
+
+async def list_snapshots(db, backup_id):
+    """
+    The kept snapshots of a backup, the latest first
+    """
+    return await db.snapshots.find(
+        {"backup": backup_id},
+        sort=[("timestamp", pymongo.DESCENDING)],
+        projection=("timestamp",)
+    ).to_list(None)
+
+
+async def find_snapshot(db, backup_id, older=0):
+    """
+    The snapshot of a backup that is older snapshots before the latest one, None if it isn't kept anymore
+    """
+    snapshots = await db.snapshots.find(
+        {"backup": backup_id},
+        sort=[("timestamp", pymongo.DESCENDING)],
+        skip=older,
+        limit=1,
+        projection=("timestamp",)
+    ).to_list(None)
+    return snapshots[0] if snapshots else None
+
+
+async def release_snapshots(db, query):
+    """
+    Delete snapshots and the blobs that aren't referenced by any other snapshot
+    """
+    snapshots = await db.snapshots.find(query, projection=("blobs",)).to_list(None)
+    if not snapshots:
+        return
+
+    refs = Counter()
+    for snapshot in snapshots:
+        refs.update(snapshot["blobs"])
+
+    await db.snapshots.delete_many({"_id": {"$in": [snapshot["_id"] for snapshot in snapshots]}})
+    await db.blobs.bulk_write([
+        pymongo.UpdateOne({"_id": key}, {"$inc": {"refs": -count}})
+        for key, count in refs.items()
+    ], ordered=False)
+    await db.blobs.delete_many({"_id": {"$in": list(refs.keys())}, "refs": {"$lte": 0}})
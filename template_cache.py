@@ -0,0 +1,98 @@
+import hashlib
+import msgpack
+import time
+from os import environ as env
+
+
+TEMPLATE_CACHE_SIZE = int(env.get("TEMPLATE_CACHE_SIZE", 100))
+TEMPLATE_CACHE_TTL = 60 * 60
+
+# Everything that is needed to show and load a template
+TEMPLATE_FIELDS = ("_id", "description", "creator", "uses", "approved", "featured", "data")
+
+
+def _checksum(packed):
+    return hashlib.sha256(packed).hexdigest()[:16]
+
+
+def template_version(template):
+    """
+    Changes whenever the template changes, templates can also be edited through the website
+    """
+    return template.get("version") or _checksum(msgpack.packb(template["data"], use_bin_type=True))
+
+
+class TemplateCache:
+    """
+    Decoded templates in memory and in redis,
+    the least frequently used template is evicted once the memory cache is full
+    """
+
+    def __init__(self, client, size=TEMPLATE_CACHE_SIZE, ttl=TEMPLATE_CACHE_TTL):
+        self.client = client
+        self.size = size
+        self.ttl = ttl
+        # name -> [uses, last use, template, expires]
+        self._templates = {}
+        self._evictions = 0
+        self.stats = {
+            "memory": 0,
+            "redis": 0,
+            "database": 0,
+            "missing": 0
+        }
+
+    def _remember(self, template, uses=1):
+        if template["_id"] not in self._templates and len(self._templates) >= self.size:
+            name = min(self._templates, key=lambda n: self._templates[n][:2])
+            del self._templates[name]
+
+            self._evictions += 1
+            if self._evictions >= self.size:
+                # Age the counts, so templates that were popular once don't stay forever
+                self._evictions = 0
+                for entry in self._templates.values():
+                    entry[0] //= 2
+
+        now = time.monotonic()
+        self._templates[template["_id"]] = [uses, now, template, now + self.ttl]
+
+    async def get(self, name):
+        entry = self._templates.get(name)
+        if entry is not None and entry[3] <= time.monotonic():
+            # Templates can also be changed through the website without an invalidation
+            self.drop(name)
+            entry = None
+
+        if entry is not None:
+            self.stats["memory"] += 1
+            entry[0] += 1
+            entry[1] = time.monotonic()
+            return entry[2]
+
+        cached = await self.client.redis.get(f"templates:{name}")
+        if cached is not None:
+            self.stats["redis"] += 1
+            template = msgpack.unpackb(cached, raw=False)
+            template["version"] = _checksum(cached)
+            self._remember(template)
+            return template
+
+        template = await self.client.db.templates.find_one({"_id": name}, projection=TEMPLATE_FIELDS)
+        if template is None:
+            self.stats["missing"] += 1
+            return None
+
+        self.stats["database"] += 1
+        packed = msgpack.packb(template, use_bin_type=True)
+        await self.client.redis.setex(f"templates:{name}", self.ttl, packed)
+        template["version"] = _checksum(packed)
+        self._remember(template)
+        return template
+
+    def drop(self, name):
+        self._templates.pop(name, None)
+
+    async def invalidate(self, name):
+        self.drop(name)
+        await self.client.redis.delete(f"templates:{name}")
@@ -1,10 +1,32 @@
 import random
+import hashlib
+import asyncio
+import math
+import time
+import traceback
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import xenon_worker as wkr
+import pymongo
+
+import views
 
 
 base36 = '0123456789abcdefghijklmnopqrstuvwxyz'
 
+# How long resolved user names are cached
+USER_CACHE_TTL = 60 * 60
+USER_CACHE_SIZE = 10000
+# Users that take longer than this to fetch are shown with their id
+USER_FETCH_TIMEOUT = 5
+
+# Embed field values can't be longer than 1024 characters
+FIELD_LIMIT = 1024
+PREVIEW_CACHE_SIZE = 100
+PREVIEW_TTL = 60 * 60
+_previews = OrderedDict()
+_user_cache = {}
+
 
 def base36_dumps(number: int):
     if number < 0:
@@ -75,51 +97,125 @@ class IterWaitFor:
         return await self.client.wait_for(*self.args, **self.kwargs)
 
 
-def channel_tree(channels):
+def code_block(lines, limit=None):
+    """
+    Join the lines into a code block,
+    stops before the limit is exceeded instead of cutting the result afterwards
+    """
+    parts = ["```"]
+    size = 6
+    for i, line in enumerate(lines):
+        if i > 0:
+            line = "\n" + line
+
+        if limit is not None and size + len(line) > limit - 5:
+            parts.append("\n...\n")
+            break
+
+        parts.append(line)
+        size += len(line)
+
+    parts.append("```")
+    return "".join(parts)
+
+
+def _channel_lines(channels):
     text = []
     voice = []
     ctg = []
+    # parent id -> (text channels, voice channels)
+    children = {}
 
     for channel in sorted(channels, key=lambda c: c.position):
-        if channel.type == wkr.ChannelType.GUILD_VOICE:
-            voice.append(channel)
-
-        elif channel.type == wkr.ChannelType.GUILD_CATEGORY:
+        if channel.type == wkr.ChannelType.GUILD_CATEGORY:
             ctg.append(channel)
+            continue
 
-        else:
-            text.append(channel)
+        is_voice = channel.type == wkr.ChannelType.GUILD_VOICE
+        if channel.parent_id is None:
+            (voice if is_voice else text).append(channel)
 
-    result = "```"
-    text_no_ctg = filter(lambda t: t.parent_id is None, text)
-    for channel in text_no_ctg:
-        result += "\n#\u200a" + channel.name
+        else:
+            children.setdefault(channel.parent_id, ([], []))[is_voice].append(channel)
 
-    voice_no_ctg = filter(lambda v: v.parent_id is None, voice)
-    for channel in voice_no_ctg:
-        result += "\n<\u200a" + channel.name
+    yield ""
+    for channel in text:
+        yield "#\u200a" + channel.name
 
-    result += "\n"
+    for channel in voice:
+        yield "<\u200a" + channel.name
 
+    yield ""
     for category in ctg:
-        result += "\n°\u200a" + category.name
-        t_children = filter(lambda c: c.parent_id == category.id, text)
+        yield "°\u200a" + category.name
+        t_children, v_children = children.get(category.id, ((), ()))
         for channel in t_children:
-            result += "\n  #\u200a" + channel.name
+            yield "  #\u200a" + channel.name
 
-        v_children = filter(lambda c: c.parent_id == category.id, voice)
         for channel in v_children:
-            result += "\n  <\u200a" + channel.name
+            yield "  <\u200a" + channel.name
+
+        yield ""
 
-        result += "\n"
 
-    return result + "```"
+def channel_tree(channels, limit=None):
+    return code_block(_channel_lines(channels), limit)
+
+
+def interval_slot(key, hours, after):
+    """
+    The first point in time after 'after' that falls into the stable slot of key within the period,
+    spreads intervals evenly instead of clustering them around the time they were enabled
+    """
+    period = int(hours * 60 * 60)
+    offset = int(hashlib.sha256(str(key).encode("utf-8")).hexdigest(), 16) % period
+    elapsed = int((after - datetime(1970, 1, 1)).total_seconds())
+    slot = elapsed + (offset - elapsed) % period
+    if slot <= elapsed:
+        slot += period
+
+    return datetime(1970, 1, 1) + timedelta(seconds=slot)
+
+
+def role_list(roles, limit=None):
+    return code_block((r.name for r in sorted(roles, key=lambda r: r.position, reverse=True)), limit)
+
+
+def cached_preview(key):
+    entry = _previews.get(key)
+    if entry is None:
+        return None
+
+    if entry[0] <= time.monotonic():
+        del _previews[key]
+        return None
+
+    _previews.move_to_end(key)
+    return entry[1]
+
+
+def guild_preview(key, data):
+    """
+    Channel tree and role list of the guild data fitting into embed fields,
+    memoized per key, the key has to change when the data changes
+    """
+    preview = cached_preview(key)
+    if preview is not None:
+        return preview
+
+    guild = views.GuildView(data)
+    preview = channel_tree(guild.channels, limit=FIELD_LIMIT), role_list(guild.roles, limit=FIELD_LIMIT)
+    _previews[key] = (time.monotonic() + PREVIEW_TTL, preview)
+    if len(_previews) > PREVIEW_CACHE_SIZE:
+        _previews.popitem(last=False)
+
+    return preview
 
 
 def backup_options(options):
     parsed_options = {}
     for option in options:
-        option = option.replace("-", "_").lower()
+        option = option.lstrip("-").replace("-", "_").lower()
         if option.startswith("!"):
             parsed_options[option[1:]] = False
 
@@ -127,3 +223,155 @@ def backup_options(options):
             parsed_options[option] = True
 
     return parsed_options
+
+
+async def resolve_users(client, user_ids):
+    """
+    Get the names of multiple users at once, cached in memory and in redis,
+    users that can't be fetched are left out
+    """
+    now = time.monotonic()
+    if len(_user_cache) > USER_CACHE_SIZE:
+        for user_id, (expires, _) in list(_user_cache.items()):
+            if expires <= now:
+                del _user_cache[user_id]
+
+        # All entries have the same ttl, the first ones expire first
+        while len(_user_cache) > USER_CACHE_SIZE:
+            del _user_cache[next(iter(_user_cache))]
+
+    names = {}
+    missing = []
+    for user_id in set(user_ids):
+        cached = _user_cache.get(user_id)
+        if cached is not None and cached[0] > now:
+            names[user_id] = cached[1]
+
+        else:
+            missing.append(user_id)
+
+    if missing:
+        cached = await client.redis.mget(*[f"users:{user_id}" for user_id in missing])
+        for user_id, name in zip(missing, cached):
+            if name is not None:
+                names[user_id] = name.decode("utf-8")
+                _user_cache.pop(user_id, None)
+                _user_cache[user_id] = (now + USER_CACHE_TTL, names[user_id])
+
+        missing = [user_id for user_id in missing if user_id not in names]
+
+    async def _fetch(user_id):
+        try:
+            return user_id, str(await asyncio.wait_for(client.fetch_user(user_id), timeout=USER_FETCH_TIMEOUT))
+        except (wkr.NotFound, asyncio.TimeoutError):
+            return user_id, None
+        except wkr.DiscordException:
+            traceback.print_exc()
+            return user_id, None
+
+    fetched = await asyncio.gather(*[_fetch(user_id) for user_id in missing])
+    fetched = {user_id: name for user_id, name in fetched if name is not None}
+    if fetched:
+        tr = client.redis.multi_exec()
+        for user_id, name in fetched.items():
+            tr.setex(f"users:{user_id}", USER_CACHE_TTL, name)
+            _user_cache.pop(user_id, None)
+            _user_cache[user_id] = (now + USER_CACHE_TTL, name)
+
+        await tr.execute()
+        names.update(fetched)
+
+    return names
+
+
+async def listen(client, channel_name, handler, on_subscribe=None):
+    """
+    Pass every message on the redis channel to the handler,
+    subscribes again if the connection drops and calls on_subscribe to catch up on missed messages
+    """
+    while True:
+        try:
+            channel, = await client.redis.subscribe(channel_name)
+            if on_subscribe is not None:
+                await on_subscribe()
+
+            while await channel.wait_message():
+                message = await channel.get(encoding="utf-8")
+                try:
+                    await handler(message)
+                except Exception:
+                    traceback.print_exc()
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            traceback.print_exc()
+
+        await asyncio.sleep(5)
+
+
+class BloomFilter:
+    """
+    Set membership without false negatives, only a small fraction of the keys that were never added match
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(str(key).encode("utf-8"), digest_size=16).digest()
+        a, b = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+        return ((a + i * b) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, key):
+        return all(self.bits[position // 8] & (1 << (position % 8)) for position in self._positions(key))
+
+
+class KeysetListMenu(wkr.ListMenu):
+    """
+    List menu that continues after the sort keys of the last item instead of skipping,
+    deep pages cost the same as the first one
+    """
+    sort = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The sort keys of the last item of the previous page
+        self._cursors = {0: None}
+
+    def _after(self, cursor):
+        conditions = []
+        for i, (key, direction) in enumerate(self.sort):
+            condition = {k: v for (k, _), v in zip(self.sort[:i], cursor)}
+            condition[key] = {"$lt" if direction == pymongo.DESCENDING else "$gt": cursor[i]}
+            conditions.append(condition)
+
+        return {"$or": conditions}
+
+    async def find(self, collection, filter, **kwargs):
+        args = {
+            "limit": 10,
+            "sort": self.sort,
+            "filter": filter
+        }
+        cursor = self._cursors.get(self.page)
+        if cursor is not None:
+            args["filter"] = {"$and": [filter, self._after(cursor)]}
+
+        elif self.page > 0:
+            # Skipped pages, only happens if the menu jumps
+            args["skip"] = self.page * 10
+
+        documents = await collection.find(**args, **kwargs).to_list(10)
+        if len(documents) == 10:
+            last = documents[-1]
+            self._cursors[self.page + 1] = [last.get(key) for key, _ in self.sort]
+
+        return documents
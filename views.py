@@ -0,0 +1,85 @@
+import xenon_worker as wkr
+
+
+def _field(key, default=None):
+    return property(lambda self: self._data.get(key, default))
+
+
+class RoleView:
+    """
+    Read-only role over the raw role dict, fields are only read when they are accessed
+    """
+    __slots__ = ("_data",)
+
+    def __init__(self, data):
+        self._data = data
+
+    id = _field("id")
+    name = _field("name")
+    position = property(lambda self: self._data.get("position") or 0)
+    color = _field("color", 0)
+    permissions = _field("permissions", 0)
+    managed = _field("managed", False)
+
+    def to_dict(self):
+        return self._data
+
+
+class ChannelView:
+    """
+    Read-only channel over the raw channel dict, fields are only read when they are accessed
+    """
+    __slots__ = ("_data",)
+
+    def __init__(self, data):
+        self._data = data
+
+    id = _field("id")
+    name = _field("name")
+    position = property(lambda self: self._data.get("position") or 0)
+    parent_id = _field("parent_id")
+    topic = _field("topic")
+
+    @property
+    def type(self):
+        return wkr.ChannelType(self._data["type"])
+
+    def to_dict(self):
+        return self._data
+
+
+class GuildView:
+    """
+    Read-only guild over raw guild data like backups and templates store it,
+    the roles and channels are wrapped on the first access and members are never touched
+    """
+    __slots__ = ("_data", "_roles", "_channels")
+
+    def __init__(self, data):
+        self._data = data
+        self._roles = None
+        self._channels = None
+
+    id = _field("id")
+    name = _field("name")
+
+    @property
+    def roles(self):
+        if self._roles is None:
+            self._roles = [RoleView(role) for role in self._data.get("roles", [])]
+
+        return self._roles
+
+    @property
+    def channels(self):
+        if self._channels is None:
+            self._channels = [ChannelView(channel) for channel in self._data.get("channels", [])]
+
+        return self._channels
+
+    @property
+    def default_role(self):
+        return next((role for role in self.roles if role.id == self.id), None)
+
+    def to_dict(self):
+        return self._data